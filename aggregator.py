@@ -1,16 +1,73 @@
+from array import array
+from bisect import bisect_right
+import fnmatch
+import heapq
+from itertools import izip
 import logging
+import math
+from operator import itemgetter
+import re
+from struct import unpack
+import threading
 from time import time
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 log = logging.getLogger(__name__)
 
 # This is used to ensure that metrics with a timestamp older than
 # RECENT_POINT_THRESHOLD_DEFAULT seconds (or the value passed in to
-# the MetricsAggregator constructor) get discarded rather than being
-# input into the incorrect bucket. Currently, the MetricsAggregator
-# does not support submitting values for the past, and all values get
-# submitted for the timestamp passed into the flush() function.
+# the MetricsAggregator constructor) get discarded. Points are submitted for
+# the timestamp of the next flush, unless they have a timestamp from before
+# the last flush: they then go in a bucket of their interval, which is
+# flushed with the bucket's timestamp.
 RECENT_POINT_THRESHOLD_DEFAULT = 30
 
+# Percentiles computed for histograms unless configured otherwise.
+DEFAULT_PERCENTILES = [0.95]
+
+# Aggregates reported for histograms unless configured otherwise, in the order
+# they're reported.
+DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
+HISTOGRAM_AGGREGATES = ('max', 'median', 'avg', 'count')
+
+# Histogram backends: "exact" keeps every sample, "sketch" keeps a
+# bounded-memory approximation of their distribution.
+HISTOGRAM_BACKENDS = ('exact', 'sketch')
+DEFAULT_SKETCH_RELATIVE_ERROR = 0.01
+DEFAULT_SKETCH_MAX_BUCKETS = 2048
+# Values smaller than this in absolute value are counted as zeros.
+SKETCH_MIN_VALUE = 1e-9
+
+# Values of dogstatsd packets: ints, decimals or scientific notation.
+NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$')
+
+# Number of (name, tags) strings of dogstatsd packets whose context is cached.
+DEFAULT_CONTEXT_CACHE_SIZE = 10000
+
+# Number of index bits of the HyperLogLog sketches of sets, they use
+# 2 ** precision bytes and have a standard error of 1.04 / sqrt(2 ** precision).
+DEFAULT_HLL_PRECISION = 14
+
+# What happens to new contexts of a metric name that has too many: they are
+# dropped, or folded into one context of that name tagged with OVERFLOW_TAGS.
+CONTEXT_OVERFLOW_DROP = 'drop'
+CONTEXT_OVERFLOW_TAG = 'tag'
+CONTEXT_OVERFLOW_POLICIES = (CONTEXT_OVERFLOW_DROP, CONTEXT_OVERFLOW_TAG)
+OVERFLOW_TAGS = ('dogstatsd_overflow:true',)
+# Our own metrics aren't subject to the context limits.
+INTERNAL_METRIC_PREFIX = 'datadog.dogstatsd.'
+
+# How counters and gauges are stored: one object per context, or columns of
+# values indexed by context id.
+STORAGE_ENGINES = ('objects', 'columns')
+
+# Metric names tracked per reported top name, by the ingestion accounting.
+TOP_NAMES_CAPACITY_FACTOR = 10
+
 class Infinity(Exception): pass
 class UnknownValue(Exception): pass
 
@@ -21,6 +78,12 @@ class Metric(object):
     and performs roll-ups within those intervals.
     """
 
+    # There is one metric object per context, so they use slots rather than
+    # a __dict__ to keep their memory footprint small.
+    __slots__ = (
+        'formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time',
+    )
+
     def sample(self, value, sample_rate):
         """ Add a point to the given metric. """
         raise NotImplementedError()
@@ -29,10 +92,17 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the unflushed state of another metric of the same context
+        into this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
 
+    __slots__ = ('value',)
+
     def __init__(self, formatter, name, tags, hostname, device_name):
         self.formatter = formatter
         self.name = name
@@ -61,10 +131,19 @@ class Gauge(Metric):
 
         return []
 
+    def merge(self, other):
+        # Last write wins.
+        if other.value is not None and (self.value is None
+                or other.last_sample_time >= self.last_sample_time):
+            self.value = other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
 
+    __slots__ = ('value',)
+
     def __init__(self, formatter, name, tags, hostname, device_name):
         self.formatter = formatter
         self.name = name
@@ -72,9 +151,10 @@ class Counter(Metric):
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
+        self.last_sample_time = None
 
     def sample(self, value, sample_rate):
-        self.value += value * int(1 / sample_rate)
+        self.value += value / sample_rate
         self.last_sample_time = time()
 
     def flush(self, timestamp, interval):
@@ -91,42 +171,118 @@ class Counter(Metric):
         finally:
             self.value = 0
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
 
-    def __init__(self, formatter, name, tags, hostname, device_name):
+    __slots__ = ('count', 'samples', 'weights', 'percentiles', 'aggregates')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, percentiles=None,
+                 aggregates=None):
         self.formatter = formatter
         self.name = name
         self.count = 0
         self.samples = []
-        self.percentiles = [0.95]
+        # Only allocated once a sampled value comes in, each sample then
+        # weighing 1 / sample_rate.
+        self.weights = None
+        if percentiles is None:
+            percentiles = DEFAULT_PERCENTILES
+        self.percentiles = percentiles
+        if aggregates is None:
+            aggregates = DEFAULT_HISTOGRAM_AGGREGATES
+        self.aggregates = aggregates
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
+        self.last_sample_time = None
 
     def sample(self, value, sample_rate):
-        self.count += int(1 / sample_rate)
         self.samples.append(value)
+        if sample_rate == 1:
+            self.count += 1
+            if self.weights is not None:
+                self.weights.append(1)
+        else:
+            weight = 1.0 / sample_rate
+            self.count += weight
+            if self.weights is None:
+                self.weights = [1] * (len(self.samples) - 1)
+            self.weights.append(weight)
         self.last_sample_time = time()
 
+    def _summarize(self):
+        """ Return a dict of the configured aggregates of the samples (but
+        count) and the configured percentiles as (percentile, value) tuples. """
+        if self.weights is not None:
+            return self._summarize_weighted()
+
+        samples = self.samples
+        length = len(samples)
+        aggregates = self.aggregates
+
+        needs_sort = self.percentiles or 'median' in aggregates
+        if needs_sort:
+            samples.sort()
+
+        values = {}
+        if 'max' in aggregates:
+            if needs_sort:
+                values['max'] = samples[-1]
+            else:
+                values['max'] = max(samples)
+        if 'median' in aggregates:
+            values['median'] = samples[int(round(length/2 - 1))]
+        if 'avg' in aggregates:
+            values['avg'] = sum(samples) / float(length)
+        percentiles = [(p, samples[max(int(round(p * length - 1)), 0)])
+            for p in self.percentiles]
+        return values, percentiles
+
+    def _summarize_weighted(self):
+        """ Same as _summarize, when samples have different weights: each
+        sample stands for `weight` values, so that ranks are taken over the
+        cumulated weights. """
+        pairs = sorted(izip(self.samples, self.weights))
+        total = float(self.count)
+        cumulated = []
+        seen = 0
+        for _, weight in pairs:
+            seen += weight
+            cumulated.append(seen)
+
+        def value_at(rank):
+            i = min(bisect_right(cumulated, max(round(rank), 0)), len(pairs) - 1)
+            return pairs[i][0]
+
+        aggregates = self.aggregates
+        values = {}
+        if 'max' in aggregates:
+            values['max'] = pairs[-1][0]
+        if 'median' in aggregates:
+            values['median'] = value_at(total / 2 - 1)
+        if 'avg' in aggregates:
+            values['avg'] = sum(v * w for v, w in pairs) / total
+        percentiles = [(p, value_at(p * total - 1)) for p in self.percentiles]
+        return values, percentiles
+
+    def _reset(self):
+        self.samples = []
+        self.weights = None
+        self.count = 0
+
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
-
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
+        values, percentiles = self._summarize()
+        values['count'] = self.count/interval
 
-        metric_aggrs = [
-            ('max', max_),
-            ('median', med),
-            ('avg', avg),
-            ('count', self.count/interval)
-        ]
+        metric_aggrs = [(suffix, values[suffix]) for suffix in self.aggregates]
 
         metrics = [self.formatter(
                 hostname=self.hostname,
@@ -138,9 +294,8 @@ class Histogram(Metric):
             ) for suffix, value in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
-            name = '%s.%spercentile' % (self.name, int(p * 100))
+        for p, val in percentiles:
+            name = '%s.%s' % (self.name, percentile_suffix(p))
             metrics.append(self.formatter(
                 hostname=self.hostname,
                 tags=self.tags,
@@ -150,29 +305,258 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
-        self.count = 0
+        self._reset()
 
         return metrics
 
+    def merge(self, other):
+        if self.weights is not None or other.weights is not None:
+            if self.weights is None:
+                self.weights = [1] * len(self.samples)
+            self.weights.extend(other.weights or [1] * len(other.samples))
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+
+class SketchHistogram(Histogram):
+    """
+    A histogram keeping a bounded-memory, log-bucketed sketch of its samples
+    instead of the samples themselves. Each bucket covers values within
+    `relative_error` of each other, so median and percentiles are accurate
+    to that relative error. Max, average and count are exact.
+
+    Once there are more than `max_buckets` buckets, the ones holding the
+    smallest values are collapsed together, trading accuracy on the low end
+    for a memory bound.
+
+    Buckets count the weight of their samples, 1 / sample_rate, so sampled
+    values weigh in the percentiles as the values they stand for.
+    """
+
+    __slots__ = (
+        'gamma', 'log_gamma', 'max_buckets', 'sum', 'min', 'max',
+        'positive', 'negative', 'zero_count',
+    )
+
+    def __init__(self, formatter, name, tags, hostname, device_name, percentiles=None,
+                 aggregates=None, relative_error=DEFAULT_SKETCH_RELATIVE_ERROR,
+                 max_buckets=DEFAULT_SKETCH_MAX_BUCKETS):
+        Histogram.__init__(self, formatter, name, tags, hostname, device_name,
+            percentiles, aggregates)
+        assert 0 < relative_error < 1
+        assert max_buckets >= 2
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        # Bucket index -> weight of the samples, for positive values and for
+        # the absolute value of negative ones.
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+    def _bucket(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def _bucket_value(self, bucket):
+        # The value that is within the relative error of the whole bucket.
+        return 2 * self.gamma ** bucket / (self.gamma + 1)
+
+    def sample(self, value, sample_rate):
+        weight = 1 if sample_rate == 1 else 1.0 / sample_rate
+        self.count += weight
+        self.sum += value * weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value > SKETCH_MIN_VALUE:
+            bucket = self._bucket(value)
+            self.positive[bucket] = self.positive.get(bucket, 0) + weight
+        elif value < -SKETCH_MIN_VALUE:
+            bucket = self._bucket(-value)
+            self.negative[bucket] = self.negative.get(bucket, 0) + weight
+        else:
+            self.zero_count += weight
+
+        if len(self.positive) + len(self.negative) > self.max_buckets:
+            self._collapse()
+        self.last_sample_time = time()
+
+    def _collapse(self):
+        """ Fold the buckets of the smallest magnitudes together until we're
+        back within max_buckets, taking them from whichever of the positive
+        and negative buckets has more. """
+        excess = len(self.positive) + len(self.negative) - self.max_buckets
+        while excess > 0:
+            buckets, others = self.positive, self.negative
+            if len(buckets) < len(others):
+                buckets, others = others, buckets
+            fold = min(excess, max(len(buckets) - len(others), 1))
+            keys = sorted(buckets)
+            target = keys[fold]
+            for key in keys[:fold]:
+                buckets[target] += buckets.pop(key)
+            excess -= fold
+
+    def _values_at(self, ranks):
+        """ Return the estimated values at the given (sorted) ranks. """
+        bins = [(-self._bucket_value(b), self.negative[b])
+            for b in sorted(self.negative, reverse=True)]
+        if self.zero_count:
+            bins.append((0, self.zero_count))
+        bins.extend([(self._bucket_value(b), self.positive[b])
+            for b in sorted(self.positive)])
+
+        values = []
+        seen = 0
+        i = 0
+        for rank in ranks:
+            while seen + bins[i][1] <= rank and i < len(bins) - 1:
+                seen += bins[i][1]
+                i += 1
+            # Estimates can't be outside of the observed range.
+            values.append(min(max(bins[i][0], self.min), self.max))
+        return values
+
+    def _summarize(self):
+        length = self.count
+        ranks = [max(int(round(p * length - 1)), 0) for p in self.percentiles]
+        if 'median' in self.aggregates:
+            ranks.append(max(int(round(length/2 - 1)), 0))
+        unique_ranks = sorted(set(ranks))
+        rank_values = dict(zip(unique_ranks, self._values_at(unique_ranks)))
+
+        values = {}
+        if 'max' in self.aggregates:
+            values['max'] = self.max
+        if 'median' in self.aggregates:
+            values['median'] = rank_values[ranks[-1]]
+        if 'avg' in self.aggregates:
+            values['avg'] = self.sum / float(length)
+        percentiles = [(p, rank_values[r]) for p, r in zip(self.percentiles, ranks)]
+        return values, percentiles
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        for buckets, other_buckets in ((self.positive, other.positive),
+                                       (self.negative, other.negative)):
+            for bucket, count in other_buckets.iteritems():
+                buckets[bucket] = buckets.get(bucket, 0) + count
+        self.zero_count += other.zero_count
+        if len(self.positive) + len(self.negative) > self.max_buckets:
+            self._collapse()
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct values added to it in constant memory:
+    2 ** precision one-byte registers, with a standard error of about
+    1.04 / sqrt(2 ** precision).
+    """
+
+    __slots__ = ('precision', 'size', 'registers', '_rank_bits', '_rank_mask')
+
+    def __init__(self, precision=DEFAULT_HLL_PRECISION):
+        assert 4 <= precision <= 18
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = array('B', [0]) * self.size
+        # Bits of the hash left once the register index is taken out.
+        self._rank_bits = 64 - precision
+        self._rank_mask = (1 << self._rank_bits) - 1
+
+    def add(self, value):
+        x = unpack('<Q', md5(str(value)).digest()[:8])[0]
+        index = x >> self._rank_bits
+        w = x & self._rank_mask
+        # Position of the leftmost 1 bit in the remaining bits.
+        if w:
+            rank = self._rank_bits - (len(bin(w)) - 2) + 1
+        else:
+            rank = self._rank_bits + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        assert self.precision == other.precision
+        registers = self.registers
+        for i, rank in enumerate(other.registers):
+            if rank > registers[i]:
+                registers[i] = rank
+
+    def cardinality(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        if estimate <= 2.5 * m:
+            # Small range correction
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = m * math.log(m / float(zeros))
+        return int(round(estimate))
+
 
 class Set(Metric):
-    """ A metric to track the number of unique elements in a set. """
+    """
+    A metric to track the number of unique elements in a set.
 
-    def __init__(self, formatter, name, tags, hostname, device_name):
+    Elements are kept in an exact set until there are more than
+    `hll_threshold` of them, at which point they're moved to a HyperLogLog
+    sketch for the rest of the flush interval. No threshold means exact
+    counting only.
+    """
+
+    __slots__ = ('values', 'sketch', 'hll_threshold', 'hll_precision')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, hll_threshold=None,
+                 hll_precision=DEFAULT_HLL_PRECISION):
         self.formatter = formatter
         self.name = name
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
         self.values = set()
+        self.sketch = None
+        self.hll_threshold = hll_threshold
+        self.hll_precision = hll_precision
+        self.last_sample_time = None
+
+    def _switch_to_sketch(self):
+        self.sketch = HyperLogLog(self.hll_precision)
+        for value in self.values:
+            self.sketch.add(value)
+        self.values = set()
 
     def sample(self, value, sample_rate):
-        self.values.add(value)
+        if self.sketch is not None:
+            self.sketch.add(value)
+        else:
+            self.values.add(value)
+            if self.hll_threshold is not None and len(self.values) > self.hll_threshold:
+                self._switch_to_sketch()
         self.last_sample_time = time()
 
     def flush(self, timestamp, interval):
-        if not self.values:
+        if self.sketch is not None:
+            value = self.sketch.cardinality()
+        elif self.values:
+            value = len(self.values)
+        else:
             return []
         try:
             return [self.formatter(
@@ -180,16 +564,33 @@ class Set(Metric):
                 device_name=self.device_name,
                 tags=self.tags,
                 metric=self.name,
-                value=len(self.values),
+                value=value,
                 timestamp=timestamp
             )]
         finally:
             self.values = set()
+            self.sketch = None
+
+    def merge(self, other):
+        if self.sketch is None and other.sketch is not None:
+            self._switch_to_sketch()
+        if self.sketch is not None:
+            if other.sketch is not None:
+                self.sketch.update(other.sketch)
+            for value in other.values:
+                self.sketch.add(value)
+        else:
+            self.values.update(other.values)
+            if self.hll_threshold is not None and len(self.values) > self.hll_threshold:
+                self._switch_to_sketch()
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
 
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
 
+    __slots__ = ('samples',)
+
     def __init__(self, formatter, name, tags, hostname, device_name):
         self.formatter = formatter
         self.name = name
@@ -197,6 +598,7 @@ class Rate(Metric):
         self.hostname = hostname
         self.device_name = device_name
         self.samples = []
+        self.last_sample_time = None
 
     def sample(self, value, sample_rate):
         ts = time()
@@ -236,6 +638,222 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+    def merge(self, other):
+        self.samples = sorted(self.samples + other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+
+class ColumnStore(object):
+    """
+    The counters or gauges of many contexts, with their values and last
+    sample times in array('d') columns indexed by an interned context id,
+    rather than in one object per context. Gauges without a value are NaN.
+    Ids of expired contexts are re-used.
+    """
+
+    def __init__(self, mtype):
+        self.mtype = mtype
+        self.empty = 0.0
+        if mtype == 'g':
+            self.empty = float('nan')
+        # context -> id, (name, raw tags) of packets -> id and id -> context
+        self.ids = {}
+        self.keys = {}
+        self.contexts = []
+        self.free_ids = []
+        self.values = array('d')
+        self.last_sample_times = array('d')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def id(self, context, now):
+        """ Return the id of the context, interning it if needed. """
+        cid = self.ids.get(context)
+        if cid is None:
+            if self.free_ids:
+                cid = self.free_ids.pop()
+                self.contexts[cid] = context
+                self.values[cid] = self.empty
+                self.last_sample_times[cid] = now
+            else:
+                cid = len(self.contexts)
+                self.contexts.append(context)
+                self.values.append(self.empty)
+                self.last_sample_times.append(now)
+            self.ids[context] = cid
+        return cid
+
+    def sample(self, cid, value, sample_rate, now):
+        if self.mtype == 'c':
+            self.values[cid] += value / sample_rate
+        else:
+            self.values[cid] = value
+        self.last_sample_times[cid] = now
+
+    def swap(self):
+        """ Start a new interval and return the values of the one that ends,
+        with copies of the columns needed to flush them. Ids and columns are
+        changed by submissions, so this is called under the aggregator's
+        lock. """
+        values = self.values
+        self.values = array('d', [self.empty]) * len(values)
+        return values, self.last_sample_times[:], self.contexts[:]
+
+    def flush(self, swapped, timestamp, interval, expiry_timestamp, formatter, hostname):
+        """ Return the points of an interval returned by `swap` and the
+        contexts that expired, in one pass over the columns. """
+        values, last_sample_times, contexts = swapped
+        is_counter = self.mtype == 'c'
+        metrics = []
+        expired = []
+        for cid, context in enumerate(contexts):
+            if context is None:
+                continue
+            if last_sample_times[cid] < expiry_timestamp:
+                expired.append(context)
+                continue
+            value = values[cid]
+            if is_counter:
+                value = value / interval
+            elif value != value:
+                continue
+            metrics.append(formatter(
+                metric=context[0],
+                value=value,
+                timestamp=timestamp,
+                tags=context[1] or None,
+                hostname=context[2] or hostname,
+                device_name=context[3]
+            ))
+        return metrics, expired
+
+    def release(self, contexts, expiry_timestamp):
+        """ Free the ids of the expired contexts that weren't sampled since
+        they were found to be, and return those contexts. Called under the
+        aggregator's lock. """
+        released = []
+        for context in contexts:
+            cid = self.ids.get(context)
+            if cid is None or self.last_sample_times[cid] >= expiry_timestamp:
+                continue
+            del self.ids[context]
+            self.contexts[cid] = None
+            self.free_ids.append(cid)
+            released.append(context)
+        if released:
+            # Packet keys may point to freed ids.
+            self.keys = {}
+        return released
+
+    def to_metrics(self, formatter, hostname):
+        """ Return the unflushed values as metric objects, by context. """
+        metric_class = self.mtype == 'c' and Counter or Gauge
+        values = self.values
+        metrics = {}
+        for cid, context in enumerate(self.contexts):
+            if context is None:
+                continue
+            value = values[cid]
+            if value != value or (metric_class is Counter and not value):
+                continue
+            metric = metric_class(formatter, context[0], context[1] or None,
+                context[2] or hostname, context[3])
+            metric.value = value
+            metric.last_sample_time = self.last_sample_times[cid]
+            metrics[context] = metric
+        return metrics
+
+    def merge_metric(self, cid, metric):
+        """ Fold a Counter or Gauge object of the context into its columns. """
+        if self.mtype == 'c':
+            self.values[cid] += metric.value
+        elif metric.value is not None and (self.values[cid] != self.values[cid]
+                or metric.last_sample_time >= self.last_sample_times[cid]):
+            self.values[cid] = metric.value
+        self.last_sample_times[cid] = max(self.last_sample_times[cid],
+            metric.last_sample_time)
+
+
+class SpaceSaving(object):
+    """
+    Approximate counts of the most frequent keys of a stream, in bounded
+    space. This is a batched variant of the Space-Saving algorithm: once
+    twice `capacity` keys are tracked, only the `capacity` most frequent are
+    kept, and new keys start from the highest count dropped. Counts are over-
+    estimated by at most `error`, and any key seen more than `error` times is
+    tracked.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self.counts = {}
+        self.error = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+        else:
+            if len(counts) >= 2 * self.capacity:
+                self._trim()
+            counts[key] = self.error + count
+
+    def _trim(self):
+        items = sorted(self.counts.iteritems(), key=itemgetter(1), reverse=True)
+        self.error = max(self.error, items[self.capacity][1])
+        self.counts = dict(items[:self.capacity])
+
+    def merge(self, other):
+        for key, count in other.counts.iteritems():
+            self.add(key, count)
+        self.error += other.error
+
+    def top(self, k):
+        """ Return the `k` most frequent keys as (key, count) tuples. """
+        return heapq.nlargest(k, self.counts.iteritems(), key=itemgetter(1))
+
+
+class ContextCache(object):
+    """
+    A bounded mapping with approximately least-recently-used eviction. Entries
+    are kept in two generations: new entries and hits on old ones go to the
+    recent generation, and once it is half the size of the cache it becomes
+    the old generation, dropping the previous one.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._generation_size = max(size / 2, 1)
+        self._recent = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._recent) + len(self._old)
+
+    def get(self, key):
+        value = self._recent.get(key)
+        if value is None and self.size:
+            value = self._old.pop(key, None)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        if len(self._recent) >= self._generation_size:
+            self._old = self._recent
+            self._recent = {}
+        self._recent[key] = value
+
+    def clear(self):
+        self._recent = {}
+        self._old = {}
+
 
 class MetricsAggregator(object):
     """
@@ -245,16 +863,96 @@ class MetricsAggregator(object):
     # Types of metrics that allow strings
     ALLOW_STRINGS = ['s', ]
 
-    def __init__(self, hostname, interval=1.0, expiry_seconds=300, formatter=None, recent_point_threshold=None):
+    def __init__(self, hostname, interval=1.0, expiry_seconds=300, formatter=None, recent_point_threshold=None,
+                 histogram_backend=None, histogram_percentiles=None, histogram_relative_error=None,
+                 histogram_aggregates=None, histogram_rules=None,
+                 set_hll_threshold=None, set_hll_precision=None, set_hll_patterns=None,
+                 context_cache_size=None, top_names=None,
+                 max_contexts=None, max_contexts_per_name=None, context_overflow=None,
+                 storage=None):
+        """
+        `histogram_aggregates` and `histogram_percentiles` are what every
+        histogram reports, unless its name matches one of the
+        `histogram_rules`: a list of (glob pattern, aggregates, percentiles)
+        tuples, the first matching one wins.
+
+        Sets switch to a HyperLogLog sketch of `set_hll_precision` once they
+        have more than `set_hll_threshold` elements, or right away if their
+        name matches one of the `set_hll_patterns` globs.
+
+        `context_cache_size` bounds the number of packet name & tags
+        resolved to their metric object that are cached.
+
+        If `top_names` is set, the aggregator keeps track of the metric names
+        that get the most packets and have the most contexts, and reports
+        that many of each on flush. Packets are counted per name in bounded
+        memory, contexts per name are counted exactly.
+
+        The number of contexts can be capped with `max_contexts` in total and
+        `max_contexts_per_name` per metric name. Points for new contexts over
+        the total are dropped, over the per name cap they are dropped or
+        folded in an overflow context, depending on `context_overflow`.
+
+        With the 'columns' `storage`, counters and gauges are kept in
+        ColumnStores rather than as one object per context.
+        """
+        # Contexts sampled since the last flush, and the others until they
+        # expire. Idle contexts are indexed by expiry time in a heap so
+        # flushes only look at the ones that are due, and counters, which
+        # report 0 while idle, are also kept apart. A context has at most one
+        # entry in the heap, pushed when it first goes idle and pushed back
+        # with its current expiry time when it comes up too early.
         self.metrics = {}
+        self.idle = {}
+        self.idle_counters = {}
+        self.expiry_heap = []
+        self.expiry_scheduled = set()
+        # The generation being flushed, while its contexts are neither live
+        # nor idle.
+        self.flushing = {}
         self.total_count = 0
         self.count = 0
+
+        # Incremented on every flush, when the live generation is swapped.
+        self.generation = 0
+        # Held by the submitting thread while it submits a datagram or a
+        # point, and by flush() while it swaps the generations and moves the
+        # flushed contexts to the idle ones.
+        self._lock = threading.Lock()
+        if context_cache_size is None:
+            context_cache_size = DEFAULT_CONTEXT_CACHE_SIZE
+        self.context_cache = ContextCache(int(context_cache_size))
+
+        histogram_backend = histogram_backend or 'exact'
+        if histogram_backend not in HISTOGRAM_BACKENDS:
+            raise Exception('Unknown histogram backend: %s' % histogram_backend)
+        self.histogram_backend = histogram_backend
+        self.histogram_relative_error = float(histogram_relative_error or DEFAULT_SKETCH_RELATIVE_ERROR)
+
+        if histogram_aggregates is None:
+            histogram_aggregates = DEFAULT_HISTOGRAM_AGGREGATES
+        if histogram_percentiles is None:
+            histogram_percentiles = DEFAULT_PERCENTILES
+        self.histogram_settings = self._check_histogram_settings(
+            histogram_aggregates, histogram_percentiles)
+        self.histogram_rules = []
+        for pattern, aggregates, percentiles in histogram_rules or []:
+            self.histogram_rules.append((re.compile(fnmatch.translate(pattern)),
+                self._check_histogram_settings(aggregates, percentiles)))
+
+        if set_hll_threshold is not None:
+            set_hll_threshold = int(set_hll_threshold)
+        self.set_hll_threshold = set_hll_threshold
+        self.set_hll_precision = int(set_hll_precision or DEFAULT_HLL_PRECISION)
+        self.set_hll_patterns = [re.compile(fnmatch.translate(pattern))
+            for pattern in set_hll_patterns or []]
+
         self.metric_type_to_class = {
             'g': Gauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
-            's': Set,
+            'h': self._histogram,
+            'ms': self._histogram,
+            's': self._set,
             '_dd-r': Rate,
         }
         self.hostname = hostname
@@ -265,76 +963,382 @@ class MetricsAggregator(object):
         recent_point_threshold = recent_point_threshold or RECENT_POINT_THRESHOLD_DEFAULT
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
+        self.num_bad_lines = 0
+
+        # How to parse the value of packets, per metric type.
+        self.value_parsers = {}
+        for mtype in self.metric_type_to_class:
+            if mtype in self.ALLOW_STRINGS:
+                self.value_parsers[mtype] = parse_set_value
+            else:
+                self.value_parsers[mtype] = parse_number
+
+        # Ingestion accounting: the names with the most packets since the
+        # last flush, approximately, and the top names as of the last flush.
+        # The names with the most contexts come from the exact per name
+        # context counts below, which have an entry per metric name.
+        self.top_names = int(top_names or 0)
+        self.packet_names = None
+        if self.top_names:
+            self.packet_names = SpaceSaving(self.top_names * TOP_NAMES_CAPACITY_FACTOR)
+        self.top_packets = []
+        self.top_contexts = []
+
+        # Context limits. Contexts per name are counted as they're created
+        # and uncounted when they expire, for the limits and the top names.
+        self.max_contexts = int(max_contexts or 0)
+        self.max_contexts_per_name = int(max_contexts_per_name or 0)
+        context_overflow = context_overflow or CONTEXT_OVERFLOW_DROP
+        if context_overflow not in CONTEXT_OVERFLOW_POLICIES:
+            raise Exception('Unknown context overflow policy: %s' % context_overflow)
+        self.context_overflow = context_overflow
+        self.count_contexts = bool(self.max_contexts or self.max_contexts_per_name
+            or self.top_names)
+        self.name_contexts = {}
+        self.num_context_overflows = 0
+
+        storage = storage or 'objects'
+        if storage not in STORAGE_ENGINES:
+            raise Exception('Unknown storage engine: %s' % storage)
+        self.storage = storage
+        self.column_stores = {}
+        if storage == 'columns':
+            self.column_stores = {'c': ColumnStore('c'), 'g': ColumnStore('g')}
+
+        # Late points, per interval: {bucket timestamp: {context: metric}}.
+        # Their new contexts are counted apart, until the buckets are flushed,
+        # and later points for buckets that were flushed are discarded.
+        self.buckets = {}
+        self.late_name_contexts = {}
+        self.num_late_contexts = 0
+        self.flushed_buckets = set()
+        self.last_flush_time = time()
+
+    @staticmethod
+    def _check_histogram_settings(aggregates, percentiles):
+        for aggregate in aggregates:
+            if aggregate not in HISTOGRAM_AGGREGATES:
+                raise Exception('Unknown histogram aggregate: %s' % aggregate)
+        suffixes = {}
+        for p in percentiles:
+            if not 0 < p <= 1:
+                raise Exception('Percentiles must be in ]0, 1]: %s' % p)
+            suffix = percentile_suffix(p)
+            if suffix in suffixes:
+                raise Exception('Percentiles %s and %s are both reported as %s' % (
+                    suffixes[suffix], p, suffix))
+            suffixes[suffix] = p
+        return list(aggregates), list(percentiles)
+
+    def _histogram(self, formatter, name, tags, hostname, device_name):
+        """ Build a histogram with the configured backend and the aggregates
+        and percentiles of the first rule matching its name. """
+        aggregates, percentiles = self.histogram_settings
+        for pattern, settings in self.histogram_rules:
+            if pattern.match(name):
+                aggregates, percentiles = settings
+                break
+
+        if self.histogram_backend == 'sketch':
+            return SketchHistogram(formatter, name, tags, hostname, device_name,
+                percentiles=percentiles, aggregates=aggregates,
+                relative_error=self.histogram_relative_error)
+        return Histogram(formatter, name, tags, hostname, device_name,
+            percentiles=percentiles, aggregates=aggregates)
+
+    def _set(self, formatter, name, tags, hostname, device_name):
+        """ Build a set, counted approximately from the start if its name
+        matches one of the HyperLogLog patterns. """
+        hll_threshold = self.set_hll_threshold
+        for pattern in self.set_hll_patterns:
+            if pattern.match(name):
+                hll_threshold = 0
+                break
+        return Set(formatter, name, tags, hostname, device_name,
+            hll_threshold=hll_threshold, hll_precision=self.set_hll_precision)
 
     def packets_per_second(self, interval):
         return round(float(self.count)/interval, 2)
 
     def submit_packets(self, packets):
+        """
+        Parse and submit the `name:value|type[|@sample_rate][|#tag1,tag2]`
+        lines of a datagram. Malformed lines are counted and skipped.
+        """
+        self._lock.acquire()
+        try:
+            self._submit_packets(packets)
+        finally:
+            self._lock.release()
+
+    def _submit_packets(self, packets):
+        context_cache = self.context_cache
+        value_parsers = self.value_parsers
+        packet_names = self.packet_names
+        column_stores = self.column_stores
+        now = time()
 
         for packet in packets.split("\n"):
             self.count += 1
-            # We can have colons in tags, so split once.
-            name_and_metadata = packet.split(':', 1)
-
-            if not packet.strip():
+            if not packet or packet.isspace():
                 continue
 
-            if len(name_and_metadata) != 2:
-                raise Exception('Unparseable packet: %s' % packet)
-
-            name = name_and_metadata[0]
-            metadata = name_and_metadata[1].split('|')
-
-            if len(metadata) < 2:
-                raise Exception('Unparseable packet: %s' % packet)
+            # We can have colons in tags, so split once.
+            name, _, metadata = packet.partition(':')
+            metadata = metadata.split('|')
+            if not name or len(metadata) < 2:
+                self._bad_line(packet)
+                continue
+            if packet_names is not None:
+                packet_names.add(name)
 
-            # Try to cast as an int first to avoid precision issues, then as a
-            # float.
-            try:
-                value = int(metadata[0])
-            except ValueError:
-                try:
-                    value = float(metadata[0])
-                except ValueError:
-
-                    # If the data type is Set, we will allow strings
-                    if metadata[1] in self.ALLOW_STRINGS:
-                        value = metadata[0]
-                    else:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception('Metric value must be a number: %s, %s' % (name, metadata[0]))
+            # Dispatch on the type to parse the value, which gives ints
+            # rather than floats when possible to avoid precision issues.
+            mtype = metadata[1]
+            parse_value = value_parsers.get(mtype)
+            if parse_value is None:
+                self._bad_line(packet)
+                continue
+            value = parse_value(metadata[0])
+            if value is None:
+                self._bad_line(packet)
+                continue
 
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
-            tags = None
+            raw_tags = None
+            valid = True
             for m in metadata[2:]:
                 # Parse the sample rate
-                if m[0] == '@':
-                    sample_rate = float(m[1:])
-                    assert 0 <= sample_rate <= 1
-                elif m[0] == '#':
-                    tags = tuple(sorted(m[1:].split(',')))
+                if m[:1] == '@':
+                    sample_rate = parse_number(m[1:])
+                    if sample_rate is None or not 0 < sample_rate <= 1:
+                        valid = False
+                        break
+                elif m[:1] == '#':
+                    raw_tags = m[1:]
+            if not valid:
+                self._bad_line(packet)
+                continue
 
-            # Submit the metric
-            mtype = metadata[1]
-            self.submit_metric(name, value, mtype, tags=tags, sample_rate=sample_rate)
+            cache_key = (name, raw_tags)
+            if column_stores and mtype in column_stores:
+                store = column_stores[mtype]
+                cid = store.keys.get(cache_key)
+                if cid is None:
+                    cid = self._packet_column_id(store, name, raw_tags, now)
+                    if cid is None:
+                        continue
+                if mtype == 'c':
+                    store.values[cid] += value / sample_rate
+                else:
+                    store.values[cid] = value
+                store.last_sample_times[cid] = now
+                continue
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                                device_name=None, timestamp=None, sample_rate=1):
+            # Repeated name & tags resolve to the same metric object until
+            # the next flush, so skip the tag sorting and context building.
+            cached = context_cache.get(cache_key)
+            if cached is not None and cached[0] == self.generation:
+                cached[2].sample(value, sample_rate)
+                continue
+
+            if cached is not None:
+                # Known context from a previous generation
+                context = cached[1]
+                tags = context[1] or None
+            else:
+                tags = None
+                if raw_tags is not None:
+                    tags = tuple(sorted(raw_tags.split(',')))
+                context = self._context(name, tags, None, None)
+            generation = self.generation
+            metric = self._metric(context, mtype, tags)
+            if metric is None:
+                continue
+            # Don't cache overflowing contexts, so that all their points are
+            # counted.
+            if metric.tags is not OVERFLOW_TAGS:
+                context_cache.set(cache_key, (generation, context, metric))
+            metric.sample(value, sample_rate)
+
+    def _bad_line(self, packet):
+        self.num_bad_lines += 1
+        log.debug('Unparseable packet: %s' % packet)
+
+    def _context(self, name, tags, hostname, device_name):
         # Avoid calling extra functions to dedupe tags if there are none
         if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
-        if context not in self.metrics:
+            return (name, tuple(), hostname, device_name)
+        return (name, tuple(sorted(set(tags))), hostname, device_name)
+
+    def _metric(self, context, mtype, tags):
+        """ Return the metric of the given context in the live generation,
+        creating it if needed, or None if the context is over the limits. """
+        metrics = self.metrics
+        metric = metrics.get(context)
+        if metric is None:
+            metric = self._revive(context)
+        if metric is None:
+            name, _, hostname, device_name = context
+            # Contexts being flushed are already counted.
+            if self.count_contexts and \
+                    not name.startswith(INTERNAL_METRIC_PREFIX) and \
+                    context not in self.flushing:
+                context = self._check_context_limits(context)
+                if context is None:
+                    return None
+                if context[1] is OVERFLOW_TAGS:
+                    tags = OVERFLOW_TAGS
+                    metric = metrics.get(context)
+                    if metric is None:
+                        metric = self._revive(context)
+                    if metric is not None:
+                        return metric
             metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
+            metric = metric_class(self.formatter, name, tags,
                 hostname or self.hostname, device_name)
-        cur_time = time()
-        if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
+            metrics[context] = metric
+        return metric
+
+    def _revive(self, context):
+        """ Move an idle context back to the live ones and return its metric,
+        or None if it isn't idle. Its entry in the expiry heap is dropped
+        when it comes up. """
+        metric = self.idle.pop(context, None)
+        if metric is not None:
+            self.idle_counters.pop(context, None)
+            self.metrics[context] = metric
+        return metric
+
+    def _packet_column_id(self, store, name, raw_tags, now):
+        tags = None
+        if raw_tags is not None:
+            tags = tuple(sorted(raw_tags.split(',')))
+        return self._column_id(store, self._context(name, tags, None, None), now,
+            (name, raw_tags))
+
+    def _column_id(self, store, context, now, key=None):
+        """ Return the id of the context in the column store, or None if the
+        context is over the limits. """
+        cid = store.ids.get(context)
+        if cid is None:
+            if self.count_contexts and \
+                    not context[0].startswith(INTERNAL_METRIC_PREFIX):
+                context = self._check_context_limits(context)
+                if context is None:
+                    return None
+                if context[1] is OVERFLOW_TAGS:
+                    # Not cached, so that all overflowing points are counted.
+                    return store.id(context, now)
+            cid = store.id(context, now)
+        if key is not None:
+            store.keys[key] = cid
+        return cid
+
+    def context_count(self):
+        count = len(self.metrics) + len(self.idle) + len(self.flushing) + \
+            self.num_late_contexts
+        for store in self.column_stores.itervalues():
+            count += len(store)
+        return count
+
+    def _check_context_limits(self, context, late=False):
+        """ Return the context to create a metric for, counted against its
+        name, the overflow context of its name if it has too many, or None if
+        it can't be created. `late` contexts are only counted until the
+        buckets of late points are flushed. """
+        if self.max_contexts and self.context_count() >= self.max_contexts:
+            self.num_context_overflows += 1
+            return None
+        name = context[0]
+        name_count = self.name_contexts.get(name, 0)
+        late_count = self.late_name_contexts.get(name, 0)
+        if not self.max_contexts_per_name or \
+                name_count + late_count < self.max_contexts_per_name:
+            if late:
+                self.late_name_contexts[name] = late_count + 1
+                self.num_late_contexts += 1
+            else:
+                self.name_contexts[name] = name_count + 1
+            return context
+        self.num_context_overflows += 1
+        if self.context_overflow == CONTEXT_OVERFLOW_DROP:
+            return None
+        return (name, OVERFLOW_TAGS, context[2], context[3])
+
+    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
+                                device_name=None, timestamp=None, sample_rate=1):
+        self._lock.acquire()
+        try:
+            self._submit_metric(name, value, mtype, tags, hostname, device_name,
+                timestamp, sample_rate)
+        finally:
+            self._lock.release()
+
+    def _submit_metric(self, name, value, mtype, tags, hostname, device_name,
+                       timestamp, sample_rate):
+        if timestamp is not None:
+            if time() - int(timestamp) > self.recent_point_threshold:
+                self.num_discarded_old_points += 1
+                return
+            if timestamp < self.last_flush_time:
+                self._submit_late(name, value, mtype, tags, hostname, device_name,
+                    timestamp, sample_rate)
+                return
+
+        store = self.column_stores.get(mtype)
+        if store is not None:
+            now = time()
+            cid = self._column_id(store, self._context(name, tags, hostname, device_name), now)
+            if cid is not None:
+                store.sample(cid, value, sample_rate, now)
+            return
+
+        metric = self._metric(self._context(name, tags, hostname, device_name), mtype, tags)
+        if metric is not None:
+            metric.sample(value, sample_rate)
+
+    def _submit_late(self, name, value, mtype, tags, hostname, device_name,
+                     timestamp, sample_rate):
+        """ Aggregate a point from an interval that was already flushed in a
+        bucket of its own. Contexts that aren't known yet are subject to the
+        context limits. """
+        bucket = int(timestamp // self.interval * self.interval)
+        if bucket in self.flushed_buckets:
+            # Emitting the bucket again would send a second point for the
+            # same timestamp.
             self.num_discarded_old_points += 1
-        else:
-            self.metrics[context].sample(value, sample_rate)
+            return
+        metrics = self.buckets.get(bucket)
+        if metrics is None:
+            metrics = self.buckets[bucket] = {}
+        context = self._context(name, tags, hostname, device_name)
+        metric = metrics.get(context)
+        if metric is None and self.count_contexts and \
+                not name.startswith(INTERNAL_METRIC_PREFIX) and \
+                not self._known_context(context, mtype):
+            context = self._check_context_limits(context, late=True)
+            if context is None:
+                return
+            if context[1] is OVERFLOW_TAGS:
+                tags = OVERFLOW_TAGS
+                metric = metrics.get(context)
+        if metric is None:
+            metric = self.metric_type_to_class[mtype](self.formatter, name, tags,
+                hostname or self.hostname, device_name)
+            metrics[context] = metric
+        metric.sample(value, sample_rate)
+
+    def _known_context(self, context, mtype):
+        """ Return whether the context is counted already. """
+        store = self.column_stores.get(mtype)
+        if store is not None and context in store.ids:
+            return True
+        for metrics in [self.metrics, self.idle, self.flushing] + self.buckets.values():
+            if context in metrics:
+                return True
+        return False
 
     def gauge(self, name, value, tags=None, hostname=None, device_name=None, timestamp=None):
         self.submit_metric(name, value, 'g', tags, hostname, device_name, timestamp)
@@ -358,31 +1362,296 @@ class MetricsAggregator(object):
         timestamp = time()
         expiry_timestamp = timestamp - self.expiry_seconds
 
-        # Flush points and remove expired metrics. We mutate this dictionary
-        # while iterating so don't use an iterator.
+        # Swap in a fresh generation of contexts first, under the lock: points
+        # submitted while we flush go to the new one, and nothing but us
+        # touches the old one once the swap is done.
         metrics = []
-        for context, metric in self.metrics.items():
-            if metric.last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                del self.metrics[context]
-            else:
+        self._lock.acquire()
+        try:
+            flushed_metrics, self.metrics = self.metrics, {}
+            self.flushing = flushed_metrics
+            count, self.count = self.count, 0
+            # Metric objects in the context cache are now stale.
+            self.generation += 1
+            buckets, self.buckets = self.buckets, {}
+            self.late_name_contexts = {}
+            self.num_late_contexts = 0
+            # Late points older than the threshold are discarded anyway.
+            self.flushed_buckets = set([bucket for bucket in self.flushed_buckets
+                if bucket > timestamp - self.recent_point_threshold - self.interval])
+            self.flushed_buckets.update(buckets)
+            self.last_flush_time = timestamp
+
+            # Expire the idle contexts that are due. The entries of contexts
+            # that were sampled since they were pushed are pushed back if
+            # they're idle again, and dropped otherwise.
+            expiry_heap = self.expiry_heap
+            rescheduled = []
+            while expiry_heap and expiry_heap[0][0] <= timestamp:
+                _, context = heapq.heappop(expiry_heap)
+                metric = self.idle.get(context)
+                if metric is None:
+                    self.expiry_scheduled.discard(context)
+                elif metric.last_sample_time < expiry_timestamp:
+                    log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                    self._expire(context)
+                else:
+                    rescheduled.append(
+                        (metric.last_sample_time + self.expiry_seconds, context))
+            for entry in rescheduled:
+                heapq.heappush(expiry_heap, entry)
+
+            idle_counters = self.idle_counters.values()
+            column_stores = [(store, store.swap())
+                for _, store in sorted(self.column_stores.items())]
+        finally:
+            self._lock.release()
+
+        # Idle counters report 0, other idle metrics have nothing to flush.
+        # The attributes we format don't change once a metric is created, so
+        # there's no need for the lock.
+        for metric in idle_counters:
+            metrics.append(metric.formatter(
+                metric=metric.name,
+                value=0.0,
+                timestamp=timestamp,
+                tags=metric.tags,
+                hostname=metric.hostname,
+                device_name=metric.device_name
+            ))
+
+        for context, metric in flushed_metrics.iteritems():
+            if metric.last_sample_time >= expiry_timestamp:
                 metrics += metric.flush(timestamp, self.interval)
 
+        store_expired = []
+        for store, swapped in column_stores:
+            store_metrics, expired = store.flush(swapped, timestamp, self.interval,
+                expiry_timestamp, self.formatter, self.hostname)
+            metrics += store_metrics
+            store_expired.append((store, expired))
+
+        # Move the flushed contexts to the idle ones until they're sampled
+        # again.
+        self._lock.acquire()
+        try:
+            idle = self.idle
+            expiry_scheduled = self.expiry_scheduled
+            self.flushing = {}
+            for context, metric in flushed_metrics.iteritems():
+                # The context may have been re-created by a submission since
+                # the swap, merge the two if so. If it was with another type,
+                # the live one wins.
+                live = self.metrics.get(context)
+                if live is not None:
+                    if live.__class__ is metric.__class__:
+                        live.merge(metric)
+                    continue
+                if metric.last_sample_time < expiry_timestamp:
+                    log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                    self._forget(context)
+                    continue
+
+                idle[context] = metric
+                if isinstance(metric, Counter):
+                    self.idle_counters[context] = metric
+                if context not in expiry_scheduled:
+                    expiry_scheduled.add(context)
+                    heapq.heappush(expiry_heap,
+                        (metric.last_sample_time + self.expiry_seconds, context))
+
+            for store, expired in store_expired:
+                for context in store.release(expired, expiry_timestamp):
+                    log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                    self._forget(context)
+
+            if self.top_names:
+                packet_names = self.packet_names
+                self.packet_names = SpaceSaving(packet_names.capacity)
+                self.top_contexts = heapq.nlargest(self.top_names,
+                    self.name_contexts.iteritems(), key=itemgetter(1))
+        finally:
+            self._lock.release()
+
+        # Late points are flushed with the timestamp of their interval.
+        for bucket in sorted(buckets):
+            for metric in buckets[bucket].itervalues():
+                metrics += metric.flush(bucket, self.interval)
+
+        if self.top_names:
+            self.top_packets = packet_names.top(self.top_names)
+            metrics += self._top_names_metrics(timestamp)
+
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.max_contexts or self.max_contexts_per_name:
+            metrics.append(self.formatter(metric='datadog.dogstatsd.context.overflows',
+                value=self.num_context_overflows, timestamp=timestamp, tags=None,
+                hostname=self.hostname))
+            if self.num_context_overflows > 0:
+                log.warn('%s points were over the context limits' % self.num_context_overflows)
+                self.num_context_overflows = 0
+
+        if self.num_bad_lines > 0:
+            log.warn('%s unparseable packets were skipped' % self.num_bad_lines)
+            self.num_bad_lines = 0
+
         # Save some stats.
-        log.debug("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
+        log.debug("received %s payloads since last flush" % count)
+        self.total_count += count
         return metrics
 
+    def _expire(self, context):
+        self.expiry_scheduled.discard(context)
+        self.idle_counters.pop(context, None)
+        if self.idle.pop(context, None) is not None:
+            self._forget(context)
+
+    def _forget(self, context):
+        """ Stop counting an expired context against its name's limit. """
+        # Overflow contexts and our own aren't counted.
+        if self.count_contexts and context[1] is not OVERFLOW_TAGS and \
+                not context[0].startswith(INTERNAL_METRIC_PREFIX):
+            name = context[0]
+            name_count = self.name_contexts.get(name, 0)
+            if name_count > 1:
+                self.name_contexts[name] = name_count - 1
+            else:
+                self.name_contexts.pop(name, None)
+
+    def _top_names_metrics(self, timestamp):
+        metrics = []
+        for metric, top in (('datadog.dogstatsd.top.packets', self.top_packets),
+                            ('datadog.dogstatsd.top.contexts', self.top_contexts)):
+            for name, count in top:
+                metrics.append(self.formatter(metric=metric, value=count,
+                    timestamp=timestamp, tags=('metric_name:%s' % name,),
+                    hostname=self.hostname))
+        return metrics
+
+    def pop_packet_names(self):
+        """ Detach and return the packet count per name since the last call,
+        to be handed to another aggregator's `merge_packet_names`. """
+        self._lock.acquire()
+        try:
+            packet_names = self.packet_names
+            if packet_names is not None:
+                self.packet_names = SpaceSaving(packet_names.capacity)
+        finally:
+            self._lock.release()
+        return packet_names
+
+    def merge_packet_names(self, packet_names):
+        if packet_names is not None and self.packet_names is not None:
+            self.packet_names.merge(packet_names)
+
+    def flush_partial(self):
+        """
+        Detach and return the unflushed state of the aggregator, as a
+        (metrics, packet count) tuple that can be handed to another
+        aggregator's `merge_partial`. The aggregator starts over empty.
+        """
+        self._lock.acquire()
+        try:
+            metrics, self.metrics = self.metrics, {}
+            count, self.count = self.count, 0
+            self.generation += 1
+            for mtype, store in self.column_stores.items():
+                metrics.update(store.to_metrics(self.formatter, self.hostname))
+                self.column_stores[mtype] = ColumnStore(mtype)
+            self.idle = {}
+            self.idle_counters = {}
+            self.expiry_heap = []
+            self.expiry_scheduled = set()
+            self.name_contexts = {}
+        finally:
+            self._lock.release()
+        return metrics, count
+
+    def merge_partial(self, metrics, count):
+        """ Merge the state returned by another aggregator's `flush_partial`
+        into this one. """
+        self._lock.acquire()
+        try:
+            self._merge_partial(metrics, count)
+        finally:
+            self._lock.release()
+
+    def _merge_partial(self, metrics, count):
+        now = time()
+        for context, metric in metrics.iteritems():
+            store = None
+            if metric.__class__ is Counter:
+                store = self.column_stores.get('c')
+            elif metric.__class__ is Gauge:
+                store = self.column_stores.get('g')
+            if store is not None:
+                cid = self._column_id(store, context, now)
+                if cid is not None:
+                    store.merge_metric(cid, metric)
+                continue
+
+            live = self.metrics.get(context)
+            if live is None:
+                live = self._revive(context)
+            # The limits are enforced here rather than by the listeners,
+            # which start over on every flush.
+            if live is None and self.count_contexts and \
+                    not context[0].startswith(INTERNAL_METRIC_PREFIX) and \
+                    context not in self.flushing:
+                context = self._check_context_limits(context)
+                if context is None:
+                    continue
+                if context[1] is OVERFLOW_TAGS:
+                    metric.tags = OVERFLOW_TAGS
+                    live = self.metrics.get(context)
+                    if live is None:
+                        live = self._revive(context)
+            if live is None:
+                metric.formatter = self.formatter
+                self.metrics[context] = metric
+            elif live.__class__ is metric.__class__:
+                live.merge(metric)
+            else:
+                # The same context was submitted with another type to another
+                # listener, the first type wins.
+                log.debug("%s was submitted as several metric types, dropping the %s" % (
+                    context, metric.__class__.__name__))
+        self.count += count
+
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
 
+def percentile_suffix(p):
+    """ Return the suffix of the name a percentile is reported as, e.g.
+    95percentile for 0.95 and 99_9percentile for 0.999. """
+    return '%spercentile' % ('%.10g' % (p * 100)).replace('.', '_')
+
+
+def parse_number(raw):
+    """ Return the value of a number as an int if possible, to avoid
+    precision issues, or a float, or None if it isn't a number. """
+    if raw.isdigit():
+        return int(raw)
+    if NUMBER_RE.match(raw) is None:
+        return None
+    if '.' in raw or 'e' in raw or 'E' in raw:
+        return float(raw)
+    return int(raw)
+
+
+def parse_set_value(raw):
+    """ Sets allow any string as a value. """
+    value = parse_number(raw)
+    if value is None:
+        return raw
+    return value
+
+
 def api_formatter(metric, value, timestamp, tags, hostname, device_name=None):
 
     # Workaround for a bug in minjson serialization
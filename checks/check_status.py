@@ -461,12 +461,26 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-        metric_count=0):
+        metric_count=0, packets_per_wakeup=0, udp_drops=None, queue_depth=None,
+        queue_drops=None, handshake_latency=0, request_latency=0,
+        retry_queue_length=0, retry_queue_size=0, retry_queue_drops=0,
+        top_packets=None, top_contexts=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
         self.packets_per_second = packets_per_second
         self.metric_count = metric_count
+        self.packets_per_wakeup = packets_per_wakeup
+        self.udp_drops = udp_drops
+        self.queue_depth = queue_depth
+        self.queue_drops = queue_drops
+        self.handshake_latency = handshake_latency
+        self.request_latency = request_latency
+        self.retry_queue_length = retry_queue_length
+        self.retry_queue_size = retry_queue_size
+        self.retry_queue_drops = retry_queue_drops
+        self.top_packets = top_packets or []
+        self.top_contexts = top_contexts or []
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -477,7 +491,23 @@ class DogstatsdStatus(AgentStatus):
             "Packet Count: %s" % self.packet_count,
             "Packets per second: %s" % self.packets_per_second,
             "Metric count: %s" % self.metric_count,
+            "Packets per wake-up: %s" % self.packets_per_wakeup,
+            "Connection handshake latency: %sms" % self.handshake_latency,
+            "Request latency: %sms" % self.request_latency,
+            "Payloads waiting to be replayed: %s (%s bytes)" % (
+                self.retry_queue_length, self.retry_queue_size),
+            "Payloads dropped from the retry queue: %s" % self.retry_queue_drops,
         ]
+        if self.udp_drops is not None:
+            lines.append("Kernel UDP drops: %s" % self.udp_drops)
+        if self.queue_depth is not None:
+            lines.append("Packet queue depth: %s" % self.queue_depth)
+            lines.append("Packet queue drops: %s" % self.queue_drops)
+        for title, top in (("Metric names with the most packets", self.top_packets),
+                           ("Metric names with the most contexts", self.top_contexts)):
+            if top:
+                lines += ["", title, "-" * len(title)]
+                lines += ["  %s: %s" % (name, count) for name, count in top]
         return lines
 
     def to_dict(self):
@@ -487,6 +517,17 @@ class DogstatsdStatus(AgentStatus):
             'packet_count': self.packet_count,
             'packets_per_second': self.packets_per_second,
             'metric_count': self.metric_count,
+            'packets_per_wakeup': self.packets_per_wakeup,
+            'udp_drops': self.udp_drops,
+            'queue_depth': self.queue_depth,
+            'queue_drops': self.queue_drops,
+            'handshake_latency': self.handshake_latency,
+            'request_latency': self.request_latency,
+            'retry_queue_length': self.retry_queue_length,
+            'retry_queue_size': self.retry_queue_size,
+            'retry_queue_drops': self.retry_queue_drops,
+            'top_packets': self.top_packets,
+            'top_contexts': self.top_contexts,
         })
         return status_info
 
@@ -495,18 +536,29 @@ class ForwarderStatus(AgentStatus):
 
     NAME = 'Forwarder'
 
-    def __init__(self, queue_length=0, queue_size=0, flush_count=0):
+    def __init__(self, queue_length=0, queue_size=0, flush_count=0, oldest_age=None,
+                 replay_rate=0, log_length=None, log_size=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
         self.flush_count = flush_count
+        self.oldest_age = oldest_age
+        self.replay_rate = replay_rate
+        self.log_length = log_length
+        self.log_size = log_size
 
     def body_lines(self):
         lines = [
-            "Queue Size: %s" % self.queue_size,
+            "Queue Size: %s bytes" % self.queue_size,
             "Queue Length: %s" % self.queue_length,
             "Flush Count: %s" % self.flush_count,
         ]
+        if self.oldest_age is not None:
+            lines.append("Oldest Transaction: %.0fs old" % self.oldest_age)
+        lines.append("Replay Rate: %.2f/s" % self.replay_rate)
+        if self.log_length is not None:
+            lines.append("Transaction Log: %s transactions, %s bytes" % (
+                self.log_length, self.log_size))
         return lines
 
     def has_error(self):
@@ -518,5 +570,9 @@ class ForwarderStatus(AgentStatus):
             'flush_count': self.flush_count,
             'queue_length': self.queue_length,
             'queue_size': self.queue_size,
+            'oldest_age': self.oldest_age,
+            'replay_rate': self.replay_rate,
+            'log_length': self.log_length,
+            'log_size': self.log_size,
         })
         return status_info
@@ -21,6 +21,7 @@ import logging
 import os
 import sys
 import threading
+import time
 import zlib
 from Queue import Queue, Full
 from subprocess import Popen
@@ -40,7 +41,7 @@ from util import Watchdog, get_uuid, get_hostname, json
 from emitter import http_emitter, format_body
 from config import get_config
 from checks.check_status import ForwarderStatus
-from transaction import Transaction, TransactionManager
+from transaction import Transaction, TransactionLog, TransactionManager
 import modules
 
 log = logging.getLogger('forwarder')
@@ -55,7 +56,20 @@ MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 # Maximum queue size in bytes (when this is reached, old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024 # 30MB
 
-THROTTLING_DELAY = timedelta(microseconds=1000000/2) # 2 msg/second
+# Transactions are sent at most THROTTLING_RATE per second on average, in
+# bursts of up to THROTTLING_BURST, and up to MAX_PARALLELISM at once
+THROTTLING_RATE = 20
+THROTTLING_DELAY = timedelta(microseconds=1000000/THROTTLING_RATE)
+THROTTLING_BURST = 20
+MAX_PARALLELISM = 4
+
+# Send the forwarder's own metrics every so many seconds
+INTERNAL_METRICS_INTERVAL = 15
+
+# Series posted within COALESCE_WINDOW seconds are sent together, in payloads
+# of up to COALESCE_MAX_SIZE bytes before compression
+COALESCE_WINDOW = 2
+COALESCE_MAX_SIZE = 2 * 1024 * 1024 # 2MB
 
 class EmitterThread(threading.Thread):
 
@@ -172,8 +186,22 @@ class MetricTransaction(Transaction):
         log.debug("Created transaction %d" % self.get_id())
         self._trManager.flush()
 
-    def __sizeof__(self):
-        return sys.getsizeof(self._data)
+    def compute_size(self):
+        # The payload and the headers, sent as "Name: value\r\n"
+        return len(self._data) + sum(len(name) + len(value) + 4
+            for name, value in self._headers.items())
+
+    def dump(self):
+        return {'headers': dict(self._headers)}, self._data
+
+    @classmethod
+    def load(cls, meta, data):
+        # Skip __init__, the transaction is neither new nor to be emitted.
+        tr = cls.__new__(cls)
+        tr._data = data
+        tr._headers = dict((str(k), str(v)) for k, v in meta['headers'].items())
+        Transaction.__init__(tr)
+        return tr
 
     def get_url(self, endpoint):
         api_key = self._application._agentConfig.get('api_key')
@@ -244,6 +272,67 @@ class APIMetricTransaction(MetricTransaction):
         return self._data
 
 
+class SeriesBatcher(object):
+    """
+    Merges the series posted within `window` seconds into a single
+    compressed APIMetricTransaction, of up to `max_size` bytes of json. A
+    window of 0 sends every payload as it comes.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW, max_size=COALESCE_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self._series = []
+        self._size = 0
+        self._payload_count = 0
+        self._timeout = None
+
+    def add(self, data, headers):
+        if not self.window:
+            APIMetricTransaction(data, headers)
+            return
+
+        try:
+            payload = data
+            if headers.get('Content-Encoding') == 'deflate':
+                payload = zlib.decompress(data)
+            series = json.loads(payload)['series']
+        except Exception:
+            log.warn("Cannot merge a series payload, sending it on its own", exc_info=True)
+            APIMetricTransaction(data, headers)
+            return
+
+        if self._series and self._size + len(payload) > self.max_size:
+            self.flush()
+        self._series.extend(series)
+        self._size += len(payload)
+        self._payload_count += 1
+
+        if self._size >= self.max_size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+                time.time() + self.window, self.flush)
+
+    def flush(self):
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
+        if not self._series:
+            return
+
+        log.debug("Sending %s series from %s payload%s" % (len(self._series),
+            self._payload_count, self._payload_count > 1 and "s" or ""))
+        data = zlib.compress(json.dumps({'series': self._series}))
+        self._series = []
+        self._size = 0
+        self._payload_count = 0
+        APIMetricTransaction(data, headers={
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'deflate',
+        })
+
+
 class StatusHandler(tornado.web.RequestHandler):
 
     def get(self):
@@ -251,6 +340,12 @@ class StatusHandler(tornado.web.RequestHandler):
 
         m = MetricTransaction.get_tr_manager()
 
+        stats = m.get_stats()
+        self.write("<table>")
+        for name in sorted(stats):
+            self.write("<tr><td>%s</td><td>%s</td></tr>" % (name, stats[name]))
+        self.write("</table>")
+
         self.write("<table><tr><td>Id</td><td>Size</td><td>Error count</td><td>Next flush</td></tr>")
         transactions = m.get_transactions()
         for tr in transactions:
@@ -289,8 +384,9 @@ class ApiInputHandler(tornado.web.RequestHandler):
         headers = self.request.headers
 
         if msg is not None:
-            # Setup a transaction for this message
-            tr = APIMetricTransaction(msg, headers)
+            # Setup a transaction for this message, with the others coming
+            # in about now
+            self.application._series_batcher.add(msg, headers)
         else:
             raise tornado.web.HTTPError(500)
 
@@ -301,10 +397,34 @@ class Application(tornado.web.Application):
         self._port = int(port)
         self._agentConfig = agentConfig
         self._metrics = {}
+        self._last_internal_metrics = time.time()
+
+        coalesce_window = agentConfig.get('forwarder_coalesce_window')
+        if coalesce_window is None:
+            coalesce_window = COALESCE_WINDOW
+        self._series_batcher = SeriesBatcher(float(coalesce_window),
+            int(agentConfig.get('forwarder_coalesce_max_size') or COALESCE_MAX_SIZE))
         MetricTransaction.set_application(self)
         MetricTransaction.set_endpoints()
+
+        transaction_log = None
+        if agentConfig.get('forwarder_queue_path'):
+            transaction_log = TransactionLog(agentConfig['forwarder_queue_path'],
+                max_size=agentConfig.get('forwarder_queue_max_disk_size'),
+                fsync=agentConfig.get('forwarder_queue_fsync'))
+
+        throttling_delay = THROTTLING_DELAY
+        throttling_rate = agentConfig.get('forwarder_throttling_rate')
+        if throttling_rate is not None:
+            throttling_rate = float(throttling_rate)
+            # A rate of 0 means no limit
+            throttling_delay = timedelta(seconds=throttling_rate and 1 / throttling_rate)
+
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-            MAX_QUEUE_SIZE, THROTTLING_DELAY)
+            MAX_QUEUE_SIZE, throttling_delay, transaction_log=transaction_log,
+            transaction_types=[MetricTransaction, APIMetricTransaction],
+            max_parallelism=int(agentConfig.get('forwarder_max_parallelism') or MAX_PARALLELISM),
+            throttling_burst=int(agentConfig.get('forwarder_throttling_burst') or THROTTLING_BURST))
         MetricTransaction.set_tr_manager(self._tr_manager)
 
         self._watchdog = None
@@ -350,6 +470,34 @@ class Application(tornado.web.Application):
                 headers={'Content-Type': 'application/json'})
             self._metrics = {}
 
+    def _postInternalMetrics(self):
+        """ Send the state of the transaction queue to Datadog. """
+        now = time.time()
+        if now - self._last_internal_metrics < INTERNAL_METRICS_INTERVAL:
+            return
+        self._last_internal_metrics = now
+        if 'dd_url' not in MetricTransaction._endpoints:
+            return
+
+        hostname = get_hostname(self._agentConfig)
+        stats = self._tr_manager.get_stats()
+        series = []
+        for name, stat in (('queue.size', 'queue_size'),
+                           ('queue.length', 'queue_length'),
+                           ('queue.oldest_age', 'oldest_age'),
+                           ('replay.rate', 'replay_rate'),
+                           ('log.size', 'log_size'),
+                           ('log.length', 'log_length')):
+            if stats.get(stat) is not None:
+                series.append({
+                    'metric': 'datadog.forwarder.%s' % name,
+                    'points': [(int(now), stats[stat])],
+                    'type': 'gauge',
+                    'host': hostname,
+                })
+        self._series_batcher.add(json.dumps({'series': series}),
+            {'Content-Type': 'application/json'})
+
     def run(self):
         handlers = [
             (r"/intake/?", AgentInputHandler),
@@ -391,6 +539,7 @@ class Application(tornado.web.Application):
             if self._watchdog:
                 self._watchdog.reset()
             self._postMetrics()
+            self._postInternalMetrics()
             self._tr_manager.flush()
 
         tr_sched = tornado.ioloop.PeriodicCallback(flush_trs,TRANSACTION_FLUSH_INTERVAL,
@@ -413,6 +562,8 @@ class Application(tornado.web.Application):
         tr_sched.start()
 
         self.mloop.start()
+        self._series_batcher.flush()
+        self._tr_manager.close()
         log.info("Stopped")
 
     def stop(self):
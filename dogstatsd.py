@@ -9,6 +9,8 @@ from config import initialize_logging; initialize_logging('dogstatsd')
 import os; os.umask(022)
 
 # stdlib
+from collections import deque
+import errno
 import httplib as http_client
 import logging
 import optparse
@@ -17,10 +19,12 @@ import re
 import select
 import signal
 import socket
+import stat
 import sys
 from time import time
 import threading
 from urllib import urlencode
+import zlib
 
 # project
 from aggregator import MetricsAggregator
@@ -36,8 +40,358 @@ WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
 LOGGING_INTERVAL = 10
 
-def serialize(metrics):
-    return json.dumps({"series" : metrics})
+# Receive buffer defaults. The buffer size is the largest datagram we will
+# read, datagrams bigger than that are truncated by the kernel.
+DEFAULT_BUFFER_SIZE = 1024
+# Maximum number of datagrams read on a single wake-up before going back to
+# select, so that a flood of packets can't prevent us from stopping.
+MAX_PACKETS_PER_WAKEUP = 1000
+
+PROC_NET_UDP = '/proc/net/udp'
+
+# Uncompressed size, in bytes, of the series payloads sent to the api. Bigger
+# flushes are split in several requests.
+MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
+
+# Payloads that couldn't be sent are kept, up to this many bytes, and
+# replayed with a back-off of RETRY_DELAY seconds per consecutive error, up
+# to MAX_RETRY_DELAY.
+DEFAULT_RETRY_QUEUE_SIZE = 32 * 1024 * 1024
+DEFAULT_RETRY_MEMORY_SIZE = 8 * 1024 * 1024
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 300
+
+# Timeouts, in seconds, of the connection to the api.
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 20
+
+# Errors of a keep-alive connection that the api closed while it was idle.
+STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+# Permissions of the unix socket, anyone can write to it by default like
+# they can to the udp port.
+DEFAULT_SOCKET_MODE = 0666
+
+# Python 2 doesn't expose SO_REUSEPORT, its value on linux is 15.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if SO_REUSEPORT is None and sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+
+# Overflow policies of the packet queue sitting between the receive loop and
+# the aggregator.
+QUEUE_DROP_OLDEST = 'drop_oldest'
+QUEUE_DROP_NEWEST = 'drop_newest'
+QUEUE_BLOCK = 'block'
+QUEUE_OVERFLOW_POLICIES = (QUEUE_DROP_OLDEST, QUEUE_DROP_NEWEST, QUEUE_BLOCK)
+
+# How long the reporter waits for the listener processes to hand over their
+# partial aggregates at flush time.
+WORKER_COLLECT_TIMEOUT = 2
+
+def serialize(metrics, max_size=None):
+    """ Yield the series payloads for the given metrics, splitting them in
+    chunks of about max_size bytes, so that a flush of many contexts never
+    holds more than one serialized chunk in memory. """
+    max_size = max_size or MAX_PAYLOAD_SIZE
+    chunk = []
+    size = 0
+    for metric in metrics:
+        serialized = json.dumps(metric)
+        if chunk and size + len(serialized) > max_size:
+            yield '{"series": [%s]}' % ','.join(chunk)
+            chunk = []
+            size = 0
+        chunk.append(serialized)
+        size += len(serialized) + 1
+    if chunk:
+        yield '{"series": [%s]}' % ','.join(chunk)
+
+def get_udp_drops(port, path=PROC_NET_UDP):
+    """ Return the number of datagrams the kernel dropped for the UDP sockets
+    bound to the given port, or None if it isn't available on this
+    platform. """
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    try:
+        lines = f.readlines()
+    finally:
+        f.close()
+
+    # The header looks like:
+    # sl local_address rem_address st tx_queue rx_queue tr tm->when retrnsmt uid timeout inode ref pointer drops
+    if not lines or not lines[0].split() or lines[0].split()[-1] != 'drops':
+        return None
+
+    hex_port = '%04X' % int(port)
+    drops = 0
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) < 13:
+            continue
+        local_port = fields[1].split(':')[-1]
+        if local_port.upper() == hex_port:
+            try:
+                drops += int(fields[-1])
+            except ValueError:
+                continue
+    return drops
+
+def packets_per_wakeup(packet_count, wakeup_count):
+    if not wakeup_count:
+        return 0
+    return round(float(packet_count) / wakeup_count, 2)
+
+
+def is_stale_connection_error(e):
+    """ Return whether an error sending a request or waiting for its response
+    means that the connection was closed before the request made it, so that
+    it's safe to send it again. Timeouts don't, the request may have been
+    received. """
+    if isinstance(e, http_client.BadStatusLine):
+        return True
+    if isinstance(e, socket.timeout) or not isinstance(e, socket.error):
+        return False
+    return bool(e.args) and e.args[0] in STALE_CONNECTION_ERRNOS
+
+def bind_unix_socket(path, mode=None, so_rcvbuf=None):
+    """ Return a non-blocking unix datagram socket bound to `path`, replacing
+    the socket a previous run left there. Any other file at `path` is left
+    alone and is an error. """
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise Exception("%s exists and isn't a socket" % path)
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    if so_rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(so_rcvbuf))
+    sock.bind(path)
+    if mode is None:
+        mode = DEFAULT_SOCKET_MODE
+    elif isinstance(mode, basestring):
+        mode = int(mode, 8)
+    os.chmod(path, mode)
+    log.info('Listening on unix socket: %s (mode %o)' % (path, mode))
+    return sock
+
+def remove_unix_socket(sock, path):
+    sock.close()
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class PacketQueue(object):
+    """
+    A bounded queue of raw datagrams, used to decouple reading the socket
+    from parsing and aggregating the packets. What happens when the queue is
+    full depends on the overflow policy: drop the oldest queued packet, drop
+    the incoming one or block the receive loop until there is room.
+    """
+
+    def __init__(self, size, overflow=QUEUE_DROP_NEWEST):
+        if overflow not in QUEUE_OVERFLOW_POLICIES:
+            raise Exception('Unknown queue overflow policy: %s' % overflow)
+        self.size = int(size)
+        if self.size <= 0:
+            raise Exception('The queue size must be positive: %s' % size)
+        self.overflow = overflow
+        self.drop_count = 0
+
+        self._packets = deque()
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+
+    def qsize(self):
+        return len(self._packets)
+
+    def put(self, packet):
+        self._mutex.acquire()
+        try:
+            if len(self._packets) >= self.size:
+                if self.overflow == QUEUE_DROP_NEWEST:
+                    self.drop_count += 1
+                    return
+                elif self.overflow == QUEUE_DROP_OLDEST:
+                    self._packets.popleft()
+                    self.drop_count += 1
+                else:
+                    while len(self._packets) >= self.size:
+                        self._not_full.wait()
+            self._packets.append(packet)
+            self._not_empty.notify()
+        finally:
+            self._mutex.release()
+
+    def get_all(self, timeout):
+        """ Wait up to `timeout` seconds for packets and return everything
+        that is queued, in order. """
+        self._mutex.acquire()
+        try:
+            if not self._packets:
+                self._not_empty.wait(timeout)
+            packets, self._packets = self._packets, deque()
+            self._not_full.notifyAll()
+            return packets
+        finally:
+            self._mutex.release()
+
+    def pop_drop_count(self):
+        drop_count, self.drop_count = self.drop_count, 0
+        return drop_count
+
+class RetryQueue(object):
+    """
+    The payloads that couldn't be sent to the api, oldest first. Payloads
+    are kept in memory up to `memory_size` bytes and, if a `path` is given,
+    spill over to files in that directory, which survive a restart. When the
+    queue holds more than `max_size` bytes the oldest payloads are dropped.
+    """
+
+    def __init__(self, max_size=None, memory_size=None, path=None, max_delay=MAX_RETRY_DELAY):
+        self.max_size = int(max_size or DEFAULT_RETRY_QUEUE_SIZE)
+        self.memory_size = int(memory_size or DEFAULT_RETRY_MEMORY_SIZE)
+        self.path = path
+        self.max_delay = max_delay
+
+        self.size = 0
+        self.drop_count = 0
+        self.error_count = 0
+        self.next_retry = 0
+
+        # [sequence number, size, compressed, body or None if on disk]
+        self._payloads = deque()
+        self._memory_used = 0
+        self._seq = 0
+        if self.path:
+            self._load()
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def _payload_path(self, seq, compressed):
+        extension = compressed and 'deflate' or 'json'
+        return os.path.join(self.path, '%020d.%s' % (seq, extension))
+
+    def _load(self):
+        """ Pick up the payloads a previous run left on disk. """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        payloads = []
+        for filename in os.listdir(self.path):
+            try:
+                seq, extension = filename.split('.')
+                seq = int(seq)
+            except ValueError:
+                continue
+            if extension not in ('deflate', 'json'):
+                continue
+            size = os.path.getsize(os.path.join(self.path, filename))
+            payloads.append([seq, size, extension == 'deflate', None])
+        payloads.sort()
+        for payload in payloads:
+            self._payloads.append(payload)
+            self.size += payload[1]
+            self._seq = payload[0] + 1
+        self._evict(0)
+        if self._payloads:
+            log.info("%s payloads (%s bytes) to replay from %s" % (
+                len(self._payloads), self.size, self.path))
+
+    def _evict(self, size):
+        while self._payloads and self.size + size > self.max_size:
+            self._remove(self._payloads.popleft())
+            self.drop_count += 1
+
+    def _remove(self, payload):
+        seq, size, compressed, body = payload
+        self.size -= size
+        if body is None:
+            try:
+                os.remove(self._payload_path(seq, compressed))
+            except OSError:
+                pass
+        else:
+            self._memory_used -= size
+
+    def _write(self, seq, compressed, body):
+        path = self._payload_path(seq, compressed)
+        f = open(path + '.tmp', 'wb')
+        try:
+            f.write(body)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+    def put(self, body, compressed):
+        size = len(body)
+        if size > self.max_size:
+            self.drop_count += 1
+            return
+        self._evict(size)
+
+        seq = self._seq
+        self._seq += 1
+        if self.path and self._memory_used + size > self.memory_size:
+            try:
+                self._write(seq, compressed, body)
+                body = None
+            except (IOError, OSError), e:
+                log.warn("Could not write payload to %s: %s" % (self.path, e))
+        if body is not None:
+            self._memory_used += size
+        self._payloads.append([seq, size, compressed, body])
+        self.size += size
+
+    def peek(self):
+        """ Return the oldest payload as a (body, compressed) tuple. """
+        seq, size, compressed, body = self._payloads[0]
+        if body is None:
+            f = open(self._payload_path(seq, compressed), 'rb')
+            try:
+                body = f.read()
+            finally:
+                f.close()
+        return body, compressed
+
+    def pop(self):
+        self._remove(self._payloads.popleft())
+
+    def time_to_retry(self, now=None):
+        return (now or time()) >= self.next_retry
+
+    def error(self, now=None):
+        self.error_count += 1
+        delay = min(self.error_count * RETRY_DELAY, self.max_delay)
+        self.next_retry = (now or time()) + delay
+
+    def success(self):
+        self.error_count = 0
+        self.next_retry = 0
+
+    def pop_drop_count(self):
+        drop_count, self.drop_count = self.drop_count, 0
+        return drop_count
+
+    def close(self):
+        """ Write the payloads held in memory to disk, if we can. """
+        if not self.path:
+            return
+        for payload in self._payloads:
+            seq, size, compressed, body = payload
+            if body is None:
+                continue
+            try:
+                self._write(seq, compressed, body)
+            except (IOError, OSError), e:
+                log.warn("Could not write payload to %s: %s" % (self.path, e))
+                return
+            payload[3] = None
+            self._memory_used -= size
+
 
 class Reporter(threading.Thread):
     """
@@ -45,11 +399,14 @@ class Reporter(threading.Thread):
     server.
     """
 
-    def __init__(self, interval, metrics_aggregator, api_host, api_key=None, use_watchdog=False):
+    def __init__(self, interval, metrics_aggregator, api_host, api_key=None, use_watchdog=False, server=None,
+                 connect_timeout=None, read_timeout=None, compress=True, max_payload_size=None,
+                 retry_queue=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        self.server = server
         self.flush_count = 0
 
         self.watchdog = None
@@ -69,10 +426,47 @@ class Reporter(threading.Thread):
             if match.group(1) == 'http':
                 self.http_conn_cls = http_client.HTTPConnection
 
+        # A keep-alive connection to the api, re-opened after errors.
+        self.http_conn = None
+        self.connect_timeout = float(connect_timeout or HTTP_CONNECT_TIMEOUT)
+        self.read_timeout = float(read_timeout or HTTP_READ_TIMEOUT)
+        # Time spent (in ms) opening connections and sending requests
+        # during the last flush.
+        self.handshake_latency = 0
+        self.request_latency = 0
+
+        self.compress = compress
+        self.max_payload_size = int(max_payload_size or MAX_PAYLOAD_SIZE)
+
+        # Payloads that failed to be sent, to be replayed.
+        if retry_queue is None:
+            retry_queue = RetryQueue()
+        self.retry_queue = retry_queue
+
     def stop(self):
         log.info("Stopping reporter")
         self.finished.set()
 
+    def _connect(self):
+        """ Return the keep-alive connection, opening it if needed. """
+        if self.http_conn is None:
+            start_time = time()
+            conn = self.http_conn_cls(self.api_host, timeout=self.connect_timeout)
+            conn.connect()
+            # The connect timeout covers the TCP and TLS handshakes, use the
+            # read timeout for the rest.
+            conn.sock.settimeout(self.read_timeout)
+            self.handshake_latency += round((time() - start_time) * 1000.0, 4)
+            self.http_conn = conn
+        return self.http_conn
+
+    def _close(self):
+        if self.http_conn is not None:
+            try:
+                self.http_conn.close()
+            finally:
+                self.http_conn = None
+
     def run(self):
 
         log.info("Reporting to %s every %ss" % (self.api_host, self.interval))
@@ -83,21 +477,39 @@ class Reporter(threading.Thread):
 
         while not self.finished.isSet(): # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            if self.server is not None:
+                try:
+                    self.server.collect()
+                except Exception:
+                    log.exception("Error collecting metrics from the listeners")
             self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
 
         # Clean up the status messages.
+        self._close()
+        self.retry_queue.close()
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
     def flush(self):
         try:
             self.flush_count += 1
+            self.handshake_latency = self.request_latency = 0
             packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
             packet_count = self.metrics_aggregator.total_count
 
+            # Receive statistics, if we know about the server.
+            server_stats = {}
+            if self.server is not None:
+                server_stats = self.server.flush_stats()
+                if server_stats.get('queue_depth') is not None:
+                    self.metrics_aggregator.gauge('datadog.dogstatsd.queue.depth',
+                        server_stats['queue_depth'])
+                    self.metrics_aggregator.gauge('datadog.dogstatsd.queue.drops',
+                        server_stats['queue_drops'])
+
             metrics = self.metrics_aggregator.flush()
             count = len(metrics)
             should_log = self.flush_count < LOGGING_INTERVAL or self.flush_count % LOGGING_INTERVAL == 0
@@ -108,6 +520,8 @@ class Reporter(threading.Thread):
                 if should_log:
                     log.info("Flush #%s: flushing %s metrics" % (self.flush_count, count))
                 self.submit(metrics)
+            if self.retry_queue:
+                self.replay()
 
             # Persist a status message.
             packet_count = self.metrics_aggregator.total_count
@@ -115,96 +529,427 @@ class Reporter(threading.Thread):
                 flush_count=self.flush_count,
                 packet_count=packet_count,
                 packets_per_second=packets_per_second,
-                metric_count=count).persist()
+                metric_count=count,
+                handshake_latency=self.handshake_latency,
+                request_latency=self.request_latency,
+                retry_queue_length=len(self.retry_queue),
+                retry_queue_size=self.retry_queue.size,
+                retry_queue_drops=self.retry_queue.pop_drop_count(),
+                top_packets=self.metrics_aggregator.top_packets,
+                top_contexts=self.metrics_aggregator.top_contexts,
+                **server_stats).persist()
 
         except:
             log.exception("Error flushing metrics")
 
     def submit(self, metrics):
+        """ Send the metrics to the api. The payloads that can't be sent are
+        queued to be replayed later. """
+        duration = 0
+        for body in serialize(metrics, self.max_payload_size):
+            if self.compress:
+                body = zlib.compress(body)
+
+            # Don't hammer an api that is failing, queue the payload behind
+            # the ones waiting to be replayed.
+            if self.retry_queue and not self.retry_queue.time_to_retry():
+                self.retry_queue.put(body, self.compress)
+                continue
+
+            try:
+                duration += self._post(body, self.compress)
+            except (http_client.HTTPException, socket.error), e:
+                self.retry_queue.put(body, self.compress)
+                self.retry_queue.error()
+                log.warn("Could not send %s bytes of metrics, will retry in %ss: %s" % (
+                    len(body), int(self.retry_queue.next_retry - time()), e))
+        return duration
+
+    def replay(self):
+        """ Resend the queued payloads, oldest first, until one fails. """
+        queue = self.retry_queue
+        count = 0
+        while queue and queue.time_to_retry():
+            body, compressed = queue.peek()
+            try:
+                self._post(body, compressed)
+            except (http_client.HTTPException, socket.error), e:
+                queue.error()
+                log.warn("Could not replay metrics (%s error(s), %s payloads queued): %s" % (
+                    queue.error_count, len(queue), e))
+                break
+            queue.pop()
+            queue.success()
+            count += 1
+        if count:
+            log.info("Replayed %s payloads, %s still queued" % (count, len(queue)))
+
+    def _post(self, body, compressed):
         # HACK - Copy and pasted from dogapi, because it's a bit of a pain to distribute python
         # dependencies with the agent.
-        body = serialize(metrics)
         headers = {'Content-Type':'application/json'}
-        method = 'POST'
+        if compressed:
+            headers['Content-Encoding'] = 'deflate'
 
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
         url = '/api/v1/series?%s' % urlencode(params)
+        return self._request('POST', url, body, headers)
 
-        start_time = time()
-        status = None
-        conn = self.http_conn_cls(self.api_host)
-        try:
-            conn.request(method, url, body, headers)
-
-            #FIXME: add timeout handling code here
+    def _request(self, method, url, body, headers):
+        # Re-use the connection, but a keep-alive connection can have been
+        # closed by the other end since the last flush: retry once on a fresh
+        # one if it was closed before any response came back. Other errors
+        # aren't retried, the api may have accepted the payload already.
+        while True:
+            reused = self.http_conn is not None
+            conn = self._connect()
+            start_time = time()
+            try:
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+            except (http_client.HTTPException, socket.error), e:
+                self._close()
+                if reused and is_stale_connection_error(e):
+                    log.debug("The api connection was closed, reconnecting: %s" % e)
+                    continue
+                raise
 
-            response = conn.getresponse()
             status = response.status
-            response.close()
-        finally:
-            conn.close()
+            try:
+                # Read the whole response so the connection can be re-used.
+                response.read()
+            except (http_client.HTTPException, socket.error):
+                self._close()
+                raise
+            if response.will_close:
+                self._close()
+            break
         duration = round((time() - start_time) * 1000.0, 4)
-        log.debug("%s %s %s%s (%sms)" % (
-                        status, method, self.api_host, url, duration))
+        self.request_latency += duration
+        log.debug("%s %s %s%s (%s bytes, %sms)" % (
+                        status, method, self.api_host, url, len(body), duration))
+        if status >= 500:
+            raise http_client.HTTPException("%s %s" % (status, response.reason))
         return duration
 
 class Server(object):
     """
-    A statsd udp server.
+    A statsd udp server. It can also listen on a unix datagram socket, either
+    bound to `socket_path` when the server starts, or already bound and given
+    as `unix_socket`.
     """
 
-    def __init__(self, metrics_aggregator, host, port):
+    def __init__(self, metrics_aggregator, host, port, buffer_size=None, so_rcvbuf=None,
+                 reuse_port=False, queue_size=None, queue_overflow=None,
+                 socket_path=None, socket_mode=None, unix_socket=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
-        self.buffer_size = 1024
+        self.buffer_size = int(buffer_size or DEFAULT_BUFFER_SIZE)
 
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if so_rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(so_rcvbuf))
+            log.info("Receive buffer size set to %s bytes" %
+                self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+        if reuse_port:
+            if SO_REUSEPORT is None:
+                raise Exception("SO_REUSEPORT is not supported on this platform")
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        self.so_rcvbuf = so_rcvbuf
+        self.socket_path = socket_path
+        self.socket_mode = socket_mode
+        self.unix_socket = unix_socket
+
+        # Optionally parse and aggregate packets in a separate thread, so
+        # that reading the socket never waits on the aggregator.
+        self.queue = None
+        if queue_size:
+            self.queue = PacketQueue(queue_size, queue_overflow or QUEUE_DROP_NEWEST)
+
+        # Receive statistics, reset on every flush.
+        self.packet_count = 0
+        self.wakeup_count = 0
 
         self.running = False
 
+    def pop_counters(self):
+        """ Return and reset the receive counters. """
+        counters = {
+            'packet_count': self.packet_count,
+            'wakeup_count': self.wakeup_count,
+            'queue_depth': None,
+            'queue_drops': None,
+        }
+        self.packet_count = self.wakeup_count = 0
+        if self.queue is not None:
+            counters['queue_depth'] = self.queue.qsize()
+            counters['queue_drops'] = self.queue.pop_drop_count()
+        return counters
+
+    def flush_stats(self):
+        """ Return the receive statistics since the last call, as
+        DogstatsdStatus keyword arguments. """
+        counters = self.pop_counters()
+        return {
+            'packets_per_wakeup': packets_per_wakeup(counters['packet_count'],
+                counters['wakeup_count']),
+            'udp_drops': get_udp_drops(self.port),
+            'queue_depth': counters['queue_depth'],
+            'queue_drops': counters['queue_drops'],
+        }
+
+    def _consume(self):
+        """ Parse and aggregate the queued packets until the server stops and
+        the queue is empty. """
+        get_all = self.queue.get_all
+        aggregator_submit = self.metrics_aggregator.submit_packets
+        timeout = UDP_SOCKET_TIMEOUT
+        while self.running or self.queue.qsize():
+            for packet in get_all(timeout):
+                try:
+                    aggregator_submit(packet)
+                except Exception:
+                    log.exception('Error processing datagram')
+
+    def prefork(self):
+        """ Called before any thread is started. Everything runs in process,
+        so there is nothing to fork. """
+        pass
+
+    def collect(self):
+        """ Called by the reporter before each flush. Everything is
+        aggregated in process, so there is nothing to collect. """
+        pass
+
     def start(self):
         """ Run the server. """
         # Bind to the UDP socket.
         self.socket.bind(self.address)
 
         log.info('Listening on host & port: %s' % str(self.address))
+        sockets = [self.socket]
+        if self.socket_path and self.unix_socket is None:
+            self.unix_socket = bind_unix_socket(self.socket_path, self.socket_mode,
+                self.so_rcvbuf)
+        if self.unix_socket is not None:
+            sockets.append(self.unix_socket)
 
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
+        max_packets = MAX_PACKETS_PER_WAKEUP
+        if self.queue is not None:
+            aggregator_submit = self.queue.put
+        else:
+            aggregator_submit = self.metrics_aggregator.submit_packets
+        socket_error = socket.error
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
+        would_block = (errno.EAGAIN, errno.EWOULDBLOCK)
 
         # Run our select loop.
         self.running = True
+        if self.queue is not None:
+            consumer = threading.Thread(target=self._consume, name='dogstatsd-consumer')
+            consumer.setDaemon(True)
+            consumer.start()
+
         while self.running:
             try:
-                ready = select_select(sock, [], [], timeout)
+                ready = select_select(sockets, [], [], timeout)
                 if ready[0]:
-                    aggregator_submit(socket_recv(buffer_size))
+                    self.wakeup_count += 1
+                for ready_socket in ready[0]:
+                    # Drain every queued datagram before going back to
+                    # select, the socket is non-blocking so we stop as
+                    # soon as the kernel buffer is empty.
+                    socket_recv = ready_socket.recv
+                    received = 0
+                    while received < max_packets:
+                        try:
+                            data = socket_recv(buffer_size)
+                        except socket_error, se:
+                            if se[0] in would_block:
+                                break
+                            raise
+                        received += 1
+                        aggregator_submit(data)
+                    self.packet_count += received
             except select_error, se:
                 # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+                if se[0] != errno.EINTR:
                     raise
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception, e:
                 log.exception('Error receiving datagram')
 
+        # Only clean up the unix socket if we bound it.
+        if self.socket_path:
+            remove_unix_socket(self.unix_socket, self.socket_path)
+
     def stop(self):
         self.running = False
 
 
+class ListenerPool(object):
+    """
+    Runs several statsd listener processes bound to the same port with
+    SO_REUSEPORT, so the kernel spreads the packets between them. Each
+    listener has its own aggregator and hands its partial aggregates over at
+    flush time, where they're merged into the reporter's aggregator, which
+    enforces the context limits.
+    """
+
+    def __init__(self, metrics_aggregator, worker_count, host, port, buffer_size=None,
+                 so_rcvbuf=None, queue_size=None, queue_overflow=None,
+                 aggregator_kwargs=None, socket_path=None, socket_mode=None):
+        # multiprocessing is only available on python >= 2.6
+        import multiprocessing
+        self._multiprocessing = multiprocessing
+
+        self.metrics_aggregator = metrics_aggregator
+        self.worker_count = int(worker_count)
+        self.host = host
+        self.port = int(port)
+        self.buffer_size = buffer_size
+        self.so_rcvbuf = so_rcvbuf
+        self.queue_size = queue_size
+        self.queue_overflow = queue_overflow
+        # Extra arguments of the listeners' aggregators.
+        self.aggregator_kwargs = aggregator_kwargs or {}
+        # The unix socket is bound once and shared by the listeners.
+        self.socket_path = socket_path
+        self.socket_mode = socket_mode
+        self.unix_socket = None
+
+        self.workers = []
+        self.counters = {}
+        self.finished = threading.Event()
+
+    def _run_worker(self, conn):
+        """ Entry point of a listener process. """
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # The context limits are enforced when merging the partial
+        # aggregates, the listeners start over on every flush.
+        aggregator_kwargs = dict(self.aggregator_kwargs)
+        for key in ('max_contexts', 'max_contexts_per_name', 'context_overflow'):
+            aggregator_kwargs.pop(key, None)
+        aggregator = MetricsAggregator(self.metrics_aggregator.hostname,
+            self.metrics_aggregator.interval, **aggregator_kwargs)
+        server = Server(aggregator, self.host, self.port,
+            buffer_size=self.buffer_size, so_rcvbuf=self.so_rcvbuf, reuse_port=True,
+            queue_size=self.queue_size, queue_overflow=self.queue_overflow,
+            unix_socket=self.unix_socket)
+
+        def respond():
+            while True:
+                try:
+                    command = conn.recv()
+                except EOFError:
+                    command = 'stop'
+                if command == 'flush':
+                    metrics, count = aggregator.flush_partial()
+                    conn.send((metrics, count, server.pop_counters(),
+                        aggregator.pop_packet_names()))
+                else:
+                    server.stop()
+                    return
+
+        responder = threading.Thread(target=respond)
+        responder.daemon = True
+        responder.start()
+        server.start()
+
+    def prefork(self):
+        """ Fork the listener processes. This is done before the reporter
+        thread is started, as forking a process with threads can leave locks
+        held forever in the child. """
+        if self.socket_path:
+            self.unix_socket = bind_unix_socket(self.socket_path, self.socket_mode,
+                self.so_rcvbuf)
+
+        for i in range(self.worker_count):
+            parent_conn, child_conn = self._multiprocessing.Pipe()
+            process = self._multiprocessing.Process(target=self._run_worker,
+                args=(child_conn,), name='dogstatsd-listener-%s' % i)
+            process.daemon = True
+            process.start()
+            self.workers.append((process, parent_conn))
+        log.info('Started %s listeners on host & port: %s' %
+            (self.worker_count, str((self.host, self.port))))
+
+    def start(self):
+        """ Fork the listener processes if that wasn't done yet, and block
+        until stopped. """
+        if not self.workers:
+            self.prefork()
+
+        # Wait with a timeout so signals still get delivered.
+        while not self.finished.isSet():
+            self.finished.wait(UDP_SOCKET_TIMEOUT)
+
+        for process, conn in self.workers:
+            try:
+                conn.send('stop')
+            except (IOError, OSError):
+                pass
+        for process, conn in self.workers:
+            process.join(UDP_SOCKET_TIMEOUT * 2)
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
+        if self.socket_path:
+            remove_unix_socket(self.unix_socket, self.socket_path)
+
+    def stop(self):
+        self.finished.set()
+
+    def collect(self):
+        """ Merge the partial aggregates of every listener into the
+        reporter's aggregator. """
+        for process, conn in self.workers:
+            try:
+                conn.send('flush')
+            except (IOError, OSError):
+                log.warn('Listener %s is gone, skipping it' % process.name)
+
+        for process, conn in self.workers:
+            try:
+                if not conn.poll(WORKER_COLLECT_TIMEOUT):
+                    log.warn('Listener %s did not answer in time' % process.name)
+                    continue
+                # A late answer from the previous flush may be queued too.
+                while conn.poll():
+                    metrics, count, counters, packet_names = conn.recv()
+                    self.metrics_aggregator.merge_partial(metrics, count)
+                    self.metrics_aggregator.merge_packet_names(packet_names)
+                    for key, value in counters.iteritems():
+                        if value is not None:
+                            self.counters[key] = self.counters.get(key, 0) + value
+            except (EOFError, IOError, OSError):
+                log.warn('Lost connection to listener %s' % process.name)
+
+    def flush_stats(self):
+        counters, self.counters = self.counters, {}
+        return {
+            'packets_per_wakeup': packets_per_wakeup(counters.get('packet_count', 0),
+                counters.get('wakeup_count', 0)),
+            'udp_drops': get_udp_drops(self.port),
+            'queue_depth': counters.get('queue_depth'),
+            'queue_drops': counters.get('queue_drops'),
+        }
+
+
 class Dogstatsd(Daemon):
     """ This class is the dogstats daemon. """
 
@@ -218,6 +963,7 @@ class Dogstatsd(Daemon):
         log.info("Adding sig handler")
         signal.signal(signal.SIGTERM, self._handle_sigterm)
         signal.signal(signal.SIGINT, self._handle_sigterm)
+        self.server.prefork()
         self.reporter.start()
         try:
             try:
@@ -241,6 +987,24 @@ class Dogstatsd(Daemon):
         return DogstatsdStatus.print_latest_status()
 
 
+def parse_histogram_rules(value):
+    """ Parse rules like `my.app.*: avg count 0.99; db.*: max` into a list
+    of (pattern, aggregates, percentiles) tuples. """
+    rules = []
+    for rule in value.split(';'):
+        if not rule.strip():
+            continue
+        pattern, settings = rule.split(':', 1)
+        aggregates = []
+        percentiles = []
+        for setting in settings.replace(',', ' ').split():
+            try:
+                percentiles.append(float(setting))
+            except ValueError:
+                aggregates.append(setting)
+        rules.append((pattern.strip(), aggregates, percentiles))
+    return rules
+
 def init(config_path=None, use_watchdog=False, use_forwarder=False):
     c = get_config(parse_args=False, cfg_path=config_path)
     log.debug("Configuration dogstatsd")
@@ -261,10 +1025,31 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False):
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsAggregator(hostname, interval, recent_point_threshold=c.get('recent_point_threshold', None))
-
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog)
+    aggregator_kwargs = {
+        'recent_point_threshold': c.get('recent_point_threshold', None),
+        'histogram_backend': c.get('histogram_backend', None),
+        'histogram_relative_error': c.get('histogram_relative_error', None),
+        'set_hll_threshold': c.get('set_hll_threshold', None),
+        'set_hll_precision': c.get('set_hll_precision', None),
+        'context_cache_size': c.get('dogstatsd_context_cache_size', None),
+        'top_names': c.get('dogstatsd_top_names', None),
+        'max_contexts': c.get('dogstatsd_max_contexts', None),
+        'max_contexts_per_name': c.get('dogstatsd_max_contexts_per_name', None),
+        'context_overflow': c.get('dogstatsd_context_overflow', None),
+        'storage': c.get('dogstatsd_storage', None),
+    }
+    if c.get('histogram_aggregates'):
+        aggregator_kwargs['histogram_aggregates'] = [a.strip()
+            for a in c['histogram_aggregates'].split(',') if a.strip()]
+    if c.get('histogram_percentiles'):
+        aggregator_kwargs['histogram_percentiles'] = [float(p)
+            for p in c['histogram_percentiles'].split(',') if p.strip()]
+    if c.get('histogram_rules'):
+        aggregator_kwargs['histogram_rules'] = parse_histogram_rules(c['histogram_rules'])
+    if c.get('set_hll_metrics'):
+        aggregator_kwargs['set_hll_patterns'] = [m.strip()
+            for m in c['set_hll_metrics'].split(',') if m.strip()]
+    aggregator = MetricsAggregator(hostname, interval, **aggregator_kwargs)
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -273,7 +1058,38 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port)
+    buffer_size = c.get('dogstatsd_buffer_size', None)
+    so_rcvbuf = c.get('dogstatsd_so_rcvbuf', None)
+    # A queue size of 0 disables the queue.
+    queue_size = int(c.get('dogstatsd_queue_size', None) or 0)
+    if queue_size < 0:
+        raise Exception('dogstatsd_queue_size must be positive or 0: %s' % queue_size)
+    queue_overflow = c.get('dogstatsd_queue_overflow', None)
+    socket_path = c.get('dogstatsd_socket', None)
+    socket_mode = c.get('dogstatsd_socket_mode', None)
+    workers = int(c.get('dogstatsd_workers', None) or 1)
+    if workers > 1:
+        server = ListenerPool(aggregator, workers, server_host, port,
+            buffer_size=buffer_size, so_rcvbuf=so_rcvbuf,
+            queue_size=queue_size, queue_overflow=queue_overflow,
+            aggregator_kwargs=aggregator_kwargs,
+            socket_path=socket_path, socket_mode=socket_mode)
+    else:
+        server = Server(aggregator, server_host, port,
+            buffer_size=buffer_size, so_rcvbuf=so_rcvbuf,
+            queue_size=queue_size, queue_overflow=queue_overflow,
+            socket_path=socket_path, socket_mode=socket_mode)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, server=server,
+        connect_timeout=c.get('dogstatsd_connect_timeout', None),
+        read_timeout=c.get('dogstatsd_read_timeout', None),
+        compress=c.get('dogstatsd_compress', 'yes').lower() in ('yes', 'true'),
+        max_payload_size=c.get('dogstatsd_max_payload_size', None),
+        retry_queue=RetryQueue(
+            max_size=c.get('dogstatsd_retry_queue_size', None),
+            memory_size=c.get('dogstatsd_retry_memory_size', None),
+            path=c.get('dogstatsd_retry_path', None)))
 
     return reporter, server
 
@@ -214,8 +214,10 @@ class StatusHandler(tornado.web.RequestHandler):
 class PostHandler(tornado.web.RequestHandler):
     def post(self):
         try:
-            body = json.loads(self.request.body)
-            series = body['series']
+            body = self.request.body
+            if self.request.headers.get('Content-Encoding') == 'deflate':
+                body = zlib.decompress(body)
+            series = json.loads(body)['series']
         except:
             #log.exception("Error parsing the POST request body")
             return
@@ -1,11 +1,73 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
-
+import sys
+from time import time
 
 from aggregator import MetricsAggregator
 
 
+def metric_size(metric):
+    """ Shallow size in bytes of a metric object and of its attributes. """
+    size = sys.getsizeof(metric)
+    if hasattr(metric, '__dict__'):
+        size += sys.getsizeof(metric.__dict__)
+    return size
+
+
+class DictCounter(object):
+    """ A counter storing its attributes in a __dict__, for comparison. """
+
+    def __init__(self, formatter, name, tags, hostname, device_name):
+        self.formatter = formatter
+        self.name = name
+        self.value = 0
+        self.tags = tags
+        self.hostname = hostname
+        self.device_name = device_name
+        self.last_sample_time = None
+
+
+def legacy_submit_packets(aggregator, packets):
+    """ The packet parser as it was before the fast path, for comparison. """
+    for packet in packets.split("\n"):
+        aggregator.count += 1
+        name_and_metadata = packet.split(':', 1)
+
+        if not packet.strip():
+            continue
+
+        if len(name_and_metadata) != 2:
+            raise Exception('Unparseable packet: %s' % packet)
+
+        name = name_and_metadata[0]
+        metadata = name_and_metadata[1].split('|')
+
+        if len(metadata) < 2:
+            raise Exception('Unparseable packet: %s' % packet)
+
+        try:
+            value = int(metadata[0])
+        except ValueError:
+            try:
+                value = float(metadata[0])
+            except ValueError:
+                if metadata[1] in aggregator.ALLOW_STRINGS:
+                    value = metadata[0]
+                else:
+                    raise Exception('Metric value must be a number: %s, %s' % (name, metadata[0]))
+
+        sample_rate = 1
+        tags = None
+        for m in metadata[2:]:
+            if m[0] == '@':
+                sample_rate = float(m[1:])
+                assert 0 <= sample_rate <= 1
+            elif m[0] == '#':
+                tags = tuple(sorted(m[1:].split(',')))
+
+        mtype = metadata[1]
+        aggregator.submit_metric(name, value, mtype, tags=tags, sample_rate=sample_rate)
 
 
 class TestAggregatorPerf(object):
@@ -41,6 +103,101 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+    def test_parse_throughput(self):
+        datagram = "\n".join([
+            'counter.%s:%s|c|#tag1,tag2' % (j, j) for j in xrange(self.METRIC_COUNT)] + [
+            'gauge.%s:%s.5|g|@0.5' % (j, j) for j in xrange(self.METRIC_COUNT)] + [
+            'histogram.%s:%s|h|#tag1,tag2|@0.5' % (j, j) for j in xrange(self.METRIC_COUNT)] + [
+            'set.%s:user%s|s' % (j, j) for j in xrange(self.METRIC_COUNT)])
+        line_count = self.METRIC_COUNT * 4 * self.LOOPS_PER_FLUSH
+
+        for label, submit in [
+                ('legacy', lambda ma: legacy_submit_packets(ma, datagram)),
+                ('fast path', lambda ma: ma.submit_packets(datagram))]:
+            ma = MetricsAggregator('my.host')
+            start = time()
+            for _ in xrange(self.LOOPS_PER_FLUSH):
+                submit(ma)
+            duration = time() - start
+            ma.flush()
+            print "%s parser: %.0f lines/s" % (label, line_count / duration)
+
+    def test_context_cache_perf(self):
+        for cache_size in [0, 10000]:
+            ma = MetricsAggregator('my.host', context_cache_size=cache_size)
+            for _ in xrange(self.FLUSH_COUNT):
+                for i in xrange(self.LOOPS_PER_FLUSH):
+                    for j in xrange(self.METRIC_COUNT):
+                        ma.submit_packets('counter.%s:%s|c|#env:prod,role:web,az:us-east-1a' % (j, i))
+                ma.flush()
+
+    def test_histogram_backends_perf(self):
+        for backend in ['exact', 'sketch']:
+            ma = MetricsAggregator('my.host', histogram_backend=backend)
+            for _ in xrange(self.FLUSH_COUNT):
+                for i in xrange(self.LOOPS_PER_FLUSH * self.METRIC_COUNT):
+                    ma.submit_packets('timer:%s|ms' % i)
+                ma.flush()
+
+    def test_sparse_flush_perf(self):
+        # Many contexts, few of them active on any given flush.
+        ma = MetricsAggregator('my.host')
+        for i in xrange(self.LOOPS_PER_FLUSH * 100):
+            ma.submit_packets('gauge.%s:1|g|#tag1,tag2' % i)
+        ma.flush()
+
+        start = time()
+        for _ in xrange(self.FLUSH_COUNT):
+            for i in xrange(self.METRIC_COUNT):
+                ma.submit_packets('gauge.%s:1|g|#tag1,tag2' % i)
+            ma.flush()
+        duration = time() - start
+        print "%s idle contexts: %.2fms per flush" % (len(ma.idle),
+            duration * 1000 / self.FLUSH_COUNT)
+
+    def test_storage_engines_perf(self):
+        context_count = self.LOOPS_PER_FLUSH * 10
+        datagrams = ["\n".join(['counter.%s:1|c|#tag1,tag2' % j,
+            'gauge.%s:%s|g|#tag1,tag2' % (j, i)]) for j in xrange(context_count)
+            for i in xrange(2)]
+        sample_count = 2 * len(datagrams)
+
+        for storage in ['objects', 'columns']:
+            ma = MetricsAggregator('my.host', storage=storage)
+            start = time()
+            for datagram in datagrams:
+                ma.submit_packets(datagram)
+            duration = time() - start
+            flush_start = time()
+            ma.flush()
+            flush_duration = time() - flush_start
+
+            if storage == 'objects':
+                size = sum([metric_size(m) for m in ma.idle.values()])
+                size += sys.getsizeof(ma.idle) + sys.getsizeof(ma.idle_counters)
+                size += sys.getsizeof(ma.context_cache._recent) + sys.getsizeof(ma.context_cache._old)
+            else:
+                size = 0
+                for store in ma.column_stores.values():
+                    size += sum([sys.getsizeof(c) for c in (store.values,
+                        store.last_sample_times, store.contexts, store.ids, store.keys)])
+            print "%s storage: %.0f samples/s, flush in %.0fms, %.0f bytes per context" % (
+                storage, sample_count / duration, flush_duration * 1000,
+                size / float(2 * context_count))
+
+    def test_context_memory(self):
+        ma = MetricsAggregator('my.host')
+        for i in xrange(self.LOOPS_PER_FLUSH * 10):
+            ma.submit_packets('counter.%s:1|c|#tag1,tag2' % i)
+            ma.submit_packets('gauge.%s:1|g|#tag1,tag2' % i)
+
+        metrics = ma.metrics.values()
+        slots_size = sum([metric_size(m) for m in metrics]) / float(len(metrics))
+        dict_size = metric_size(DictCounter(None, 'counter', None, 'my.host', None))
+        print "Bytes per metric object: %.0f with slots, %s with a __dict__" % (
+            slots_size, dict_size)
+        assert slots_size < dict_size
+
     def test_checksd_aggregation_perf(self):
         ma = MetricsAggregator('my.host')
 
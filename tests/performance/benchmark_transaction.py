@@ -0,0 +1,93 @@
+"""
+Performance tests for the forwarder transaction manager.
+"""
+from datetime import timedelta
+from time import time
+
+from transaction import Transaction, TransactionManager
+
+
+class NullTransaction(Transaction):
+    """ A transaction failing or succeeding right away, without sending
+    anything. """
+
+    def __init__(self, manager, size):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = size
+        self.is_flushable = False
+
+    def flush(self):
+        if self.is_flushable:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self)
+
+
+class TestTransactionManagerPerf(object):
+
+    TRANSACTION_COUNT = 100000
+    # Fraction of the backlog that is due on each flush
+    DUE_EVERY = 100
+
+    def _manager(self, max_queue_size):
+        return TransactionManager(timedelta(seconds=0), max_queue_size,
+            timedelta(seconds=0), max_parallelism=self.TRANSACTION_COUNT)
+
+    def test_append_perf(self):
+        # Over capacity: every append evicts a transaction.
+        m = self._manager(self.TRANSACTION_COUNT / 2)
+        start = time()
+        for i in xrange(self.TRANSACTION_COUNT):
+            m.append(NullTransaction(m, 1))
+        duration = time() - start
+        print "%s appends (%s evictions): %.2fs" % (self.TRANSACTION_COUNT,
+            self.TRANSACTION_COUNT / 2, duration)
+
+    def test_backlog_flush_perf(self):
+        # A large backlog of failing transactions, a few due on every flush.
+        m = self._manager(self.TRANSACTION_COUNT)
+        trs = [NullTransaction(m, 1) for i in xrange(self.TRANSACTION_COUNT)]
+        for tr in trs:
+            m.append(tr)
+        m.flush()
+
+        # Back off all of them but a few.
+        for i, tr in enumerate(trs):
+            if i % self.DUE_EVERY:
+                tr.inc_error_count()
+                tr.compute_next_flush(timedelta(seconds=3600))
+        # As tr_error would have queued them.
+        m._flush_heap = []
+        for tr in trs:
+            m._flush_heap.append((tr.get_next_flush(), tr.get_id()))
+        m._flush_heap.sort()
+
+        start = time()
+        m.flush()
+        duration = time() - start
+        print "Flushing %s due transactions out of %s: %.2fms" % (
+            self.TRANSACTION_COUNT / self.DUE_EVERY, self.TRANSACTION_COUNT,
+            duration * 1000)
+
+    def test_drain_perf(self):
+        # The whole backlog succeeds at once, e.g. once an outage is over.
+        m = self._manager(self.TRANSACTION_COUNT)
+        trs = [NullTransaction(m, 1) for i in xrange(self.TRANSACTION_COUNT)]
+        for tr in trs:
+            m.append(tr)
+            tr.is_flushable = True
+
+        start = time()
+        m.flush()
+        duration = time() - start
+        assert not m.get_transactions()
+        print "Draining %s transactions: %.2fs" % (self.TRANSACTION_COUNT,
+            duration)
+
+
+if __name__ == '__main__':
+    t = TestTransactionManagerPerf()
+    t.test_append_perf()
+    t.test_backlog_flush_perf()
+    t.test_drain_perf()
@@ -1,11 +1,21 @@
 
+import BaseHTTPServer
+import os
 import random
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
 import time
+import zlib
 
 import unittest
 import nose.tools as nt
 
-from dogstatsd import MetricsAggregator
+from aggregator import SpaceSaving
+from dogstatsd import ListenerPool, MetricsAggregator, PacketQueue, Reporter, RetryQueue, Server, bind_unix_socket, get_udp_drops, serialize
+from util import json
 
 
 class TestUnitDogStatsd(unittest.TestCase):
@@ -90,9 +100,126 @@ class TestUnitDogStatsd(unittest.TestCase):
 
         json = util.generate_minjson_adapter()
         dogstatsd.json = json
-        serialized = dogstatsd.serialize([api_formatter("foo", 12, 1, ('tag',), 'host')])
+        serialized = ''.join(dogstatsd.serialize([api_formatter("foo", 12, 1, ('tag',), 'host')]))
         assert '"tags": ["tag"]' in serialized
 
+    def test_context_cache(self):
+        stats = MetricsAggregator('myhost', context_cache_size=4)
+        stats.submit_packets('my.counter:1|c|#tag2,tag1')
+        stats.submit_packets('my.counter:2|c|#tag2,tag1')
+        stats.submit_packets('my.counter:4|c|#tag1,tag2')
+        nt.assert_equal(len(stats.context_cache), 2)
+        nt.assert_equal(len(stats.metrics), 1)
+
+        metrics = stats.flush()
+        nt.assert_equal([(m['tags'], m['points'][0][1]) for m in metrics],
+            [(('tag1', 'tag2'), 7)])
+
+        # Cached entries don't outlive a flush
+        stats.submit_packets('my.counter:8|c|#tag2,tag1')
+        nt.assert_equal([m['points'][0][1] for m in stats.flush()], [8])
+        stats.submit_packets('my.counter:1|c|#tag2,tag1')
+        partial, _ = stats.flush_partial()
+        stats.submit_packets('my.counter:1|c|#tag2,tag1')
+        nt.assert_equal(len(stats.metrics), 1)
+
+        # The cache is bounded
+        for i in xrange(100):
+            stats.submit_packets('my.counter.%s:1|c|#tag1' % i)
+        assert len(stats.context_cache) <= 4
+        nt.assert_equal(len(stats.flush()), 101)
+
+        # And can be disabled
+        stats = MetricsAggregator('myhost', context_cache_size=0)
+        stats.submit_packets('my.counter:1|c|#tag2,tag1')
+        nt.assert_equal(len(stats.context_cache), 0)
+        nt.assert_equal([m['points'][0][1] for m in stats.flush()], [1])
+
+    def test_space_saving(self):
+        top = SpaceSaving(4)
+        keys = ['heavy'] * 100 + ['medium'] * 50 + ['light%s' % i for i in xrange(100)]
+        random.shuffle(keys)
+        for key in keys:
+            top.add(key)
+        assert len(top) <= 8
+        heavy, medium = top.top(2)
+        nt.assert_equal([heavy[0], medium[0]], ['heavy', 'medium'])
+        # Counts are over-estimated by at most the error
+        assert 100 <= heavy[1] <= 100 + top.error
+        assert 50 <= medium[1] <= 50 + top.error
+
+        other = SpaceSaving(4)
+        other.add('medium', 60)
+        top.merge(other)
+        nt.assert_equal(top.top(1)[0][0], 'medium')
+
+    def test_top_names(self):
+        stats = MetricsAggregator('myhost', top_names=2)
+        for i in xrange(10):
+            stats.submit_packets('busy.metric:1|c|#tag:%s' % i)
+        for i in xrange(3):
+            stats.submit_packets('quiet.metric:1|c')
+        stats.submit_packets('other.metric:1|c')
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(stats.top_packets, [('busy.metric', 10), ('quiet.metric', 3)])
+        nt.assert_equal(stats.top_contexts[0], ('busy.metric', 10))
+
+        top = [m for m in metrics if m['metric'] == 'datadog.dogstatsd.top.contexts']
+        nt.assert_equal(len(top), 2)
+        nt.assert_equal(top[0]['tags'], ['metric_name:busy.metric'])
+        nt.assert_equal(top[0]['points'][0][1], 10)
+
+        # Packet counts start over on every flush, idle contexts still count.
+        stats.submit_packets('other.metric:1|c')
+        stats.flush()
+        nt.assert_equal(stats.top_packets, [('other.metric', 1)])
+        nt.assert_equal(stats.top_contexts[0], ('busy.metric', 10))
+
+        # Expired contexts don't.
+        for context in stats.idle.keys():
+            if context[0] == 'busy.metric':
+                stats._expire(context)
+        stats.flush()
+        nt.assert_equal(sorted(stats.top_contexts), [('other.metric', 1), ('quiet.metric', 1)])
+
+    def test_context_limits(self):
+        stats = MetricsAggregator('myhost', max_contexts=5, max_contexts_per_name=2)
+        for i in xrange(4):
+            stats.submit_packets('request.count:1|c|#request_id:%s' % i)
+        for i in xrange(4):
+            stats.submit_packets('other.metric.%s:1|c' % i)
+        nt.assert_equal(stats.num_context_overflows, 3)
+
+        metrics = self.sort_metrics(stats.flush())
+        overflows = [m for m in metrics if m['metric'] == 'datadog.dogstatsd.context.overflows']
+        nt.assert_equal(overflows[0]['points'][0][1], 3)
+        names = [m['metric'] for m in metrics if m['metric'] != 'datadog.dogstatsd.context.overflows']
+        nt.assert_equal(names, ['other.metric.0', 'other.metric.1', 'other.metric.2',
+            'request.count', 'request.count'])
+        nt.assert_equal(stats.num_context_overflows, 0)
+
+        # Fold the extra contexts in an overflow context
+        stats = MetricsAggregator('myhost', max_contexts_per_name=2, context_overflow='tag')
+        for i in xrange(5):
+            stats.submit_packets('request.count:1|c|#request_id:%s' % i)
+        stats.submit_packets('request.count:1|c|#request_id:4')
+        metrics = self.sort_metrics(stats.flush())
+        counts = dict((tuple(m['tags'] or ()), m['points'][0][1]) for m in metrics
+            if m['metric'] == 'request.count')
+        nt.assert_equal(counts, {
+            ('request_id:0',): 1,
+            ('request_id:1',): 1,
+            ('dogstatsd_overflow:true',): 4,
+        })
+
+        # Contexts carried over still count against the limit
+        stats.submit_packets('request.count:1|c|#request_id:5')
+        metrics = stats.flush()
+        nt.assert_equal(len([m for m in metrics if m['metric'] == 'request.count']), 3)
+
+        nt.assert_raises(Exception, MetricsAggregator, 'myhost', context_overflow='unknown')
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -174,6 +301,59 @@ class TestUnitDogStatsd(unittest.TestCase):
         nt.assert_equals(first['points'][0][1], 5)
         nt.assert_equals(first['host'], 'myhost')
 
+    def test_late_points(self):
+        stats = MetricsAggregator('myhost', interval=10, recent_point_threshold=3600)
+        stats.flush()
+        now = time.time()
+        bucket = int(now // 10 * 10)
+
+        # Points from before the last flush go in the bucket of their interval
+        stats.gauge('my.gauge', 1, timestamp=bucket - 25)
+        stats.gauge('my.gauge', 2, timestamp=bucket - 21)
+        stats.gauge('my.gauge', 3, timestamp=bucket - 5)
+        stats.submit_metric('my.counter', 20, 'c', timestamp=bucket - 25)
+        stats.submit_metric('my.counter', 30, 'c', timestamp=bucket - 22)
+        # and the others in the next flush.
+        stats.gauge('my.gauge', 4, timestamp=now + 1)
+        stats.gauge('my.gauge', 5)
+        # Points that are too old are still discarded.
+        stats.gauge('my.gauge', 6, timestamp=now - 7200)
+
+        nt.assert_equal(stats.num_discarded_old_points, 1)
+
+        metrics = stats.flush()
+        points = dict(((m['metric'], m['points'][0][0]), m['points'][0][1]) for m in metrics)
+        nt.assert_equal(len(points), 4)
+        nt.assert_equal(points[('my.gauge', bucket - 30)], 2)
+        nt.assert_equal(points[('my.counter', bucket - 30)], 5)
+        nt.assert_equal(points[('my.gauge', bucket - 10)], 3)
+        live = [m for m in metrics if m['points'][0][0] > now]
+        nt.assert_equal(live[0]['points'][0][1], 5)
+
+        # The late points didn't create contexts
+        nt.assert_equal(stats.flush(), [])
+
+        # Buckets are only flushed once, later points for them are discarded.
+        stats.gauge('my.gauge', 7, timestamp=bucket - 25)
+        nt.assert_equal(stats.num_discarded_old_points, 1)
+        nt.assert_equal(stats.flush(), [])
+
+        # New contexts of late points are subject to the context limits.
+        stats = MetricsAggregator('myhost', interval=10, recent_point_threshold=3600,
+            max_contexts_per_name=2)
+        stats.gauge('my.gauge', 1, tags=['a'])
+        stats.flush()
+        for tag in ['a', 'b', 'c']:
+            stats.gauge('my.gauge', 1, tags=[tag], timestamp=bucket - 25)
+            stats.gauge('my.gauge', 1, tags=[tag], timestamp=bucket - 15)
+        nt.assert_equal(stats.num_context_overflows, 2)
+        metrics = [m for m in stats.flush() if m['metric'] == 'my.gauge']
+        nt.assert_equal(sorted((m['points'][0][0], m['tags']) for m in metrics), [
+            (bucket - 30, ['a']), (bucket - 30, ['b']),
+            (bucket - 20, ['a']), (bucket - 20, ['b']),
+        ])
+        nt.assert_equal(stats.name_contexts, {'my.gauge': 1})
+
     def test_sets(self):
         stats = MetricsAggregator('myhost')
         stats.submit_packets('my.set:10|s')
@@ -212,6 +392,43 @@ class TestUnitDogStatsd(unittest.TestCase):
         # Assert there are no more sets
         assert not stats.flush()
 
+    def test_hyperloglog_sets(self):
+        stats = MetricsAggregator('myhost', set_hll_threshold=100, set_hll_precision=12,
+            set_hll_patterns=['approx.*'])
+        for i in xrange(50):
+            stats.submit_packets('small.set:%s|s' % i)
+            stats.submit_packets('approx.set:%s|s' % i)
+        for i in xrange(20000):
+            stats.submit_packets('big.set:user%s|s' % (i % 10000))
+
+        small, approx, big = [stats.metrics[(name, (), None, None)]
+            for name in ['small.set', 'approx.set', 'big.set']]
+        assert small.sketch is None
+        assert approx.sketch is not None
+        assert big.sketch is not None
+        nt.assert_equal(len(big.values), 0)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['small.set'], 50)
+        # Small cardinalities are nearly exact thanks to the linear counting
+        # correction, larger ones are within a few standard errors.
+        assert abs(metrics['approx.set'] - 50) <= 1, metrics['approx.set']
+        assert abs(metrics['big.set'] - 10000) < 10000 * 0.05, metrics['big.set']
+
+        # Sets go back to exact counting after a flush.
+        stats.submit_packets('big.set:foo|s')
+        assert big.sketch is None
+        nt.assert_equal([m['points'][0][1] for m in stats.flush()], [1])
+
+    def test_hyperloglog_merge(self):
+        from aggregator import HyperLogLog
+        first, second = HyperLogLog(12), HyperLogLog(12)
+        for i in xrange(5000):
+            first.add(i)
+            second.add(i + 2500)
+        first.update(second)
+        assert abs(first.cardinality() - 7500) < 7500 * 0.05, first.cardinality()
+
     def test_rate(self):
         stats = MetricsAggregator('myhost')
         stats.submit_packets('my.rate:10|_dd-r')
@@ -276,6 +493,106 @@ class TestUnitDogStatsd(unittest.TestCase):
         assert not metrics
 
 
+    def test_sketch_histogram(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch',
+            histogram_percentiles=[0.5, 0.95, 0.99], histogram_relative_error=0.01)
+
+        values = range(1, 10001)
+        random.shuffle(values)
+        for v in values:
+            stats.submit_packets('my.sketch:%s|ms' % v)
+        stats.submit_packets('my.sketch:0|ms')
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(sorted(metrics), ['my.sketch.50percentile',
+            'my.sketch.95percentile', 'my.sketch.99percentile', 'my.sketch.avg',
+            'my.sketch.count', 'my.sketch.max', 'my.sketch.median'])
+
+        def assert_within_error(value, expected, error=0.01):
+            assert abs(value - expected) <= expected * error, "%s %s" % (value, expected)
+
+        # Exact aggregates
+        nt.assert_equal(metrics['my.sketch.max'], 10000)
+        nt.assert_equal(metrics['my.sketch.count'], 10001)
+        nt.assert_almost_equal(metrics['my.sketch.avg'], 50005000 / 10001.0)
+        # Approximated ones
+        assert_within_error(metrics['my.sketch.median'], 5000)
+        assert_within_error(metrics['my.sketch.50percentile'], 5000)
+        assert_within_error(metrics['my.sketch.95percentile'], 9500)
+        assert_within_error(metrics['my.sketch.99percentile'], 9900)
+
+        # Ensure that histograms are reset.
+        assert not stats.flush()
+
+    def test_sketch_histogram_is_bounded(self):
+        from aggregator import SketchHistogram
+        h = SketchHistogram(None, 'my.sketch', None, 'myhost', None, max_buckets=100)
+        samples = []
+        for i in xrange(1, 100000, 7):
+            samples.extend([i * 1.5, -i])
+        for v in samples:
+            h.sample(v, 1)
+        assert len(h.positive) + len(h.negative) <= 100
+
+        other = SketchHistogram(None, 'my.sketch', None, 'myhost', None, max_buckets=100)
+        other.sample(10 ** 9, 0.5)
+        h.merge(other)
+        assert len(h.positive) + len(h.negative) <= 100
+        nt.assert_equal(h.max, 10 ** 9)
+        nt.assert_equal(h.count, len(samples) + 2)
+
+        # The high end is still accurate
+        samples.append(10 ** 9)
+        samples.sort()
+        expected = samples[int(round(0.95 * len(samples) - 1))]
+        values, percentiles = h._summarize()
+        nt.assert_equal(values['max'], 10 ** 9)
+        p95 = percentiles[0][1]
+        assert abs(p95 - expected) <= expected * 0.01, "%s %s" % (p95, expected)
+
+    def test_histogram_rules(self):
+        from dogstatsd import parse_histogram_rules
+        rules = parse_histogram_rules('api.*: avg, count 0.99; db.query: max ;')
+        nt.assert_equal(rules, [('api.*', ['avg', 'count'], [0.99]), ('db.query', ['max'], [])])
+
+        for backend in ['exact', 'sketch']:
+            stats = MetricsAggregator('myhost', histogram_backend=backend,
+                histogram_aggregates=['max', 'count'], histogram_rules=rules)
+            for i in xrange(1, 101):
+                stats.submit_packets('api.latency:%s|ms' % i)
+                stats.submit_packets('db.query:%s|ms' % i)
+                stats.submit_packets('other.timer:%s|ms' % i)
+
+            metrics = sorted(m['metric'] for m in stats.flush())
+            nt.assert_equal(metrics, ['api.latency.99percentile', 'api.latency.avg',
+                'api.latency.count', 'db.query.max', 'other.timer.95percentile',
+                'other.timer.count', 'other.timer.max'])
+
+        nt.assert_raises(Exception, MetricsAggregator, 'myhost', histogram_aggregates=['p42'])
+
+        # Fractional percentiles keep their precision in their names
+        for backend in ['exact', 'sketch']:
+            stats = MetricsAggregator('myhost', histogram_backend=backend,
+                histogram_aggregates=[], histogram_percentiles=[0.99, 0.995, 0.999])
+            stats.submit_packets('my.hist:1|ms')
+            metrics = sorted(m['metric'] for m in stats.flush())
+            nt.assert_equal(metrics, ['my.hist.99_5percentile', 'my.hist.99_9percentile',
+                'my.hist.99percentile'])
+        nt.assert_raises(Exception, MetricsAggregator, 'myhost',
+            histogram_percentiles=[0.5, 0.50000000000001])
+
+        # Low percentiles of few samples are the lowest sample
+        for backend in ['exact', 'sketch']:
+            stats = MetricsAggregator('myhost', histogram_backend=backend,
+                histogram_aggregates=[], histogram_percentiles=[0.05])
+            for i in xrange(1, 11):
+                stats.submit_packets('my.hist:%s|ms' % i)
+            metrics = stats.flush()
+            nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+                [('my.hist.5percentile', 1)])
+        nt.assert_raises(Exception, MetricsAggregator, 'myhost',
+            histogram_rules=[('my.*', ['max'], [0.95, 0.95])])
+
     def test_sampled_histogram(self):
         # Submit a sampled histogram.
         stats = MetricsAggregator('myhost')
@@ -290,6 +607,36 @@ class TestUnitDogStatsd(unittest.TestCase):
         for p in [p95, pavg, pmed, pmax]:
             nt.assert_equal(p['points'][0][1], 5)
 
+    def test_weighted_histogram(self):
+        for backend in ['exact', 'sketch']:
+            stats = MetricsAggregator('myhost', histogram_backend=backend)
+            # 100 values sent at full rate and a single one standing for 300
+            # values: it should weigh in as such.
+            for i in xrange(1, 101):
+                stats.submit_packets('my.hist:%s|h' % i)
+            stats.submit_packets('my.hist:1000|h|@0.003333333333333333')
+            stats.submit_packets('sampled.count:1|c|@0.3')
+
+            metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+            nt.assert_almost_equal(metrics['my.hist.count'], 400)
+            nt.assert_almost_equal(metrics['my.hist.avg'], (5050 + 300000) / 400.0)
+            nt.assert_equal(metrics['my.hist.max'], 1000)
+            assert abs(metrics['my.hist.median'] - 1000) <= 10, backend
+            assert abs(metrics['my.hist.95percentile'] - 1000) <= 10, backend
+            nt.assert_almost_equal(metrics['sampled.count'], 1 / 0.3)
+
+            # Weights follow samples through merges.
+            stats.submit_packets('my.hist:10|h')
+            stats.submit_packets('my.hist:20|h')
+            other = MetricsAggregator('myhost', histogram_backend=backend)
+            other.submit_packets('my.hist:30|h|@0.25')
+            for context, metric in other.metrics.items():
+                stats.metrics[context].merge(metric)
+            metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+            nt.assert_almost_equal(metrics['my.hist.count'], 6)
+            nt.assert_almost_equal(metrics['my.hist.avg'], 150 / 6.0)
+            assert abs(metrics['my.hist.median'] - 30) <= 0.3, backend
+
     def test_batch_submission(self):
         # Submit a sampled histogram.
         stats = MetricsAggregator('myhost')
@@ -308,25 +655,45 @@ class TestUnitDogStatsd(unittest.TestCase):
         assert gauge['points'][0][1] == 1
 
 
-    def test_bad_packets_throw_errors(self):
+    def test_bad_packets_are_skipped(self):
         packets = [
             'missing.value.and.type',
             'missing.type:2',
             'missing.value|c',
             '2|c',
+            ':2|c',
             'unknown.type:2|z',
             'string.value:abc|c',
             'string.sample.rate:0|c|@abc',
+            'zero.sample.rate:1|c|@0',
+            'nan.value:nan|g',
         ]
 
         stats = MetricsAggregator('myhost')
         for packet in packets:
-            try:
-                stats.submit_packets(packet)
-            except:
-                assert True
-            else:
-                assert False, 'invalid : %s' % packet
+            stats.submit_packets(packet)
+        nt.assert_equal(stats.num_bad_lines, len(packets))
+        assert not stats.flush()
+        nt.assert_equal(stats.num_bad_lines, 0)
+
+        # Bad lines don't take the rest of the datagram down with them.
+        stats.submit_packets('\n'.join(['good.counter:1|c'] + packets + ['good.gauge:-1.5e2|g']))
+        nt.assert_equal(stats.num_bad_lines, len(packets))
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('good.counter', 1), ('good.gauge', -150.0)])
+
+    def test_value_parsing(self):
+        from aggregator import parse_number, parse_set_value
+        for raw, expected in [('1', 1), ('-12', -12), ('+3', 3), ('1.5', 1.5),
+                              ('.5', 0.5), ('2.', 2.0), ('9.512901e-05', 9.512901e-05),
+                              ('1E3', 1000.0), ('', None), ('abc', None), ('1.2.3', None),
+                              ('1e', None), ('-', None), ('inf', None)]:
+            value = parse_number(raw)
+            nt.assert_equal(value, expected, raw)
+            nt.assert_equal(type(value), type(expected), raw)
+        nt.assert_equal(parse_set_value('abc'), 'abc')
+        nt.assert_equal(parse_set_value('12'), 12)
 
     def test_metrics_expiry(self):
         # Ensure metrics eventually expire and stop submitting.
@@ -350,6 +717,127 @@ class TestUnitDogStatsd(unittest.TestCase):
         assert stats.flush()
 
 
+    def test_idle_contexts(self):
+        stats = MetricsAggregator('myhost', expiry_seconds=10)
+        stats.submit_packets('my.counter:1|c\nmy.gauge:1|g\nother.gauge:1|g')
+        nt.assert_equal(len(stats.flush()), 3)
+        nt.assert_equal(len(stats.metrics), 0)
+        nt.assert_equal(len(stats.idle), 3)
+        nt.assert_equal(stats.idle_counters.keys(), [('my.counter', (), None, None)])
+
+        # Sampling an idle context brings it back.
+        stats.submit_packets('my.gauge:2|g')
+        nt.assert_equal(len(stats.idle), 2)
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('my.counter', 0), ('my.gauge', 2)])
+
+        # Contexts expire from the heap, unless they were sampled since.
+        stats.idle[('other.gauge', (), None, None)].last_sample_time -= 20
+        stats.idle[('my.counter', (), None, None)].last_sample_time -= 20
+        stats.expiry_heap = [(0, context) for _, context in stats.expiry_heap]
+        metrics = stats.flush()
+        nt.assert_equal(metrics, [])
+        nt.assert_equal(stats.idle.keys(), [('my.gauge', (), None, None)])
+        nt.assert_equal(stats.idle_counters, {})
+
+    def test_expiry_heap_is_bounded(self):
+        stats = MetricsAggregator('myhost', expiry_seconds=300)
+        for i in xrange(30):
+            for j in xrange(100):
+                stats.submit_packets('my.counter:1|c|#id:%s' % j)
+            stats.flush()
+        # One entry per context, however many times they went idle
+        nt.assert_equal(len(stats.expiry_heap), 100)
+
+        # Entries that come up early are pushed back with the current expiry
+        # time.
+        stats.expiry_heap = [(0, context) for _, context in stats.expiry_heap]
+        stats.flush()
+        nt.assert_equal(len(stats.expiry_heap), 100)
+        nt.assert_equal(len(stats.idle), 100)
+        assert min(stats.expiry_heap)[0] > time.time()
+
+    def test_context_limits_during_flush(self):
+        stats = MetricsAggregator('myhost', max_contexts_per_name=5)
+        stats.submit_packets('my.counter:1|c|#a\nmy.counter:1|c|#b\nmy.counter:1|c|#c')
+
+        # Contexts sampled again while they're being flushed aren't counted
+        # twice.
+        from aggregator import Counter
+        counter_flush = Counter.flush
+        def flush(self, timestamp, interval):
+            stats.submit_packets('my.counter:1|c|#%s' % self.tags[0])
+            return counter_flush(self, timestamp, interval)
+        Counter.flush = flush
+        try:
+            stats.flush()
+        finally:
+            Counter.flush = counter_flush
+        nt.assert_equal(stats.name_contexts, {'my.counter': 3})
+
+        stats.submit_packets('my.counter:1|c|#d\nmy.counter:1|c|#e')
+        nt.assert_equal(stats.num_context_overflows, 0)
+        stats.submit_packets('my.counter:1|c|#f')
+        nt.assert_equal(stats.num_context_overflows, 1)
+
+    def test_column_storage(self):
+        stats = MetricsAggregator('myhost', storage='columns', expiry_seconds=10)
+        stats.submit_packets('my.counter:1|c|#b,a\nmy.counter:2|c|#a,b\nmy.counter:3|c|@0.5')
+        stats.submit_packets('my.gauge:1|g\nmy.gauge:5|g|#host:web1')
+        stats.submit_packets('my.gauge:2|g')
+        stats.gauge('other.gauge', 3, hostname='otherhost')
+        stats.increment('other.counter', tags=['a'])
+        nt.assert_equal(len(stats.metrics), 0)
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['tags'], m['host'], m['points'][0][1]) for m in metrics], [
+            ('my.counter', None, 'myhost', 6),
+            ('my.counter', ('a', 'b'), 'myhost', 3),
+            ('my.gauge', None, 'myhost', 2),
+            ('my.gauge', ['host:web1'], 'myhost', 5),
+            ('other.counter', ['a'], 'myhost', 1),
+            ('other.gauge', None, 'otherhost', 3),
+        ])
+
+        # Counters report 0 until they expire, gauges only when sampled
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('my.counter', 0), ('my.counter', 0), ('other.counter', 0)])
+
+        store = stats.column_stores['c']
+        store.last_sample_times[store.ids[('other.counter', ('a',), None, None)]] -= 20
+        nt.assert_equal(len(stats.flush()), 2)
+        nt.assert_equal(len(store), 2)
+        # and expired ids are re-used.
+        stats.submit_packets('new.counter:1|c')
+        nt.assert_equal(len(store.contexts), 3)
+
+        # Partial flushes hand over metric objects
+        worker = MetricsAggregator('myhost', storage='columns')
+        worker.submit_packets('my.counter:10|c\nmy.gauge:7|g\nmy.histogram:1|h')
+        metrics, count = worker.flush_partial()
+        nt.assert_equal(len(metrics), 3)
+        nt.assert_equal(len(worker.column_stores['c']), 0)
+        stats.merge_partial(metrics, count)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush()
+            if not m['tags'])
+        nt.assert_equal(metrics['my.counter'], 10)
+        nt.assert_equal(metrics['my.gauge'], 7)
+        nt.assert_equal(metrics['new.counter'], 1)
+        nt.assert_equal(metrics['my.histogram.count'], 1)
+
+        # Limits apply to columns too
+        stats = MetricsAggregator('myhost', storage='columns', max_contexts_per_name=1,
+            context_overflow='tag')
+        for i in xrange(3):
+            stats.submit_packets('request.count:1|c|#request_id:%s' % i)
+        metrics = [m for m in stats.flush() if m['metric'] == 'request.count']
+        nt.assert_equal(sorted((m['tags'], m['points'][0][1]) for m in metrics),
+            [(['dogstatsd_overflow:true'], 2), (['request_id:0'], 1)])
+
+        nt.assert_raises(Exception, MetricsAggregator, 'myhost', storage='unknown')
+
     def test_diagnostic_stats(self):
         stats = MetricsAggregator('myhost')
         for i in xrange(10):
@@ -391,5 +879,461 @@ class TestUnitDogStatsd(unittest.TestCase):
         ts, val = metrics[0].get('points')[0]
         nt.assert_almost_equal(val, 9.512901e-05)
 
+    def test_submit_during_flush(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets('my.counter:1|c')
+
+        # Emulate the server thread submitting points while the reporter
+        # thread is flushing.
+        from aggregator import Counter
+        counter_flush = Counter.flush
+        def flush(self, timestamp, interval):
+            stats.submit_packets('my.counter:5|c\nmy.new.counter:1|c')
+            return counter_flush(self, timestamp, interval)
+        Counter.flush = flush
+        try:
+            metrics = self.sort_metrics(stats.flush())
+        finally:
+            Counter.flush = counter_flush
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('my.counter', 1)])
+        nt.assert_equal(stats.count, 2)
+
+        # Nothing submitted during the flush was lost
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('my.counter', 5), ('my.new.counter', 1)])
+        nt.assert_equal(stats.total_count, 3)
+
+    def test_concurrent_flush(self):
+        for storage in ('objects', 'columns'):
+            stats = MetricsAggregator('myhost', storage=storage)
+            def submit():
+                for i in xrange(20000):
+                    stats.submit_packets('my.counter:1|c|#id:%s' % (i % 500))
+            t = threading.Thread(target=submit)
+            t.start()
+            total = 0
+            while t.isAlive():
+                total += sum(m['points'][0][1] for m in stats.flush())
+            t.join()
+            total += sum(m['points'][0][1] for m in stats.flush())
+            # Nothing was lost to the generation swaps
+            nt.assert_equal(total, 20000, storage)
+
+    def test_submit_other_type_during_flush(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets('x:1|g\ny:1|g')
+
+        from aggregator import Gauge
+        gauge_flush = Gauge.flush
+        def flush(self, timestamp, interval):
+            stats.submit_packets('%s:2|c' % self.name)
+            return gauge_flush(self, timestamp, interval)
+        Gauge.flush = flush
+        try:
+            metrics = self.sort_metrics(stats.flush())
+        finally:
+            Gauge.flush = gauge_flush
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('x', 1), ('y', 1)])
+
+        # The contexts re-created with another type are kept.
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+            [('x', 2), ('y', 2)])
+        nt.assert_equal(sorted(stats.idle_counters), [('x', (), None, None), ('y', (), None, None)])
+
+    def test_merge_partial(self):
+        master = MetricsAggregator('myhost', interval=1)
+        worker1 = MetricsAggregator('myhost', interval=1)
+        worker2 = MetricsAggregator('myhost', interval=1)
+
+        master.submit_packets('my.counter:1|c')
+        worker1.submit_packets('my.counter:2|c\nmy.gauge:1|g\nmy.set:a|s\nmy.hist:1|h')
+        time.sleep(0.01)
+        worker2.submit_packets('my.counter:4|c\nmy.gauge:2|g\nmy.set:b|s\nmy.hist:3|h')
+
+        for worker in (worker2, worker1):
+            metrics, count = worker.flush_partial()
+            master.merge_partial(metrics, count)
+            # The worker starts over.
+            nt.assert_equal(worker.count, 0)
+            assert not worker.flush()
+
+        nt.assert_equal(master.count, 9)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in master.flush())
+        nt.assert_equal(metrics['my.counter'], 7)
+        # Last write wins, whatever the merge order
+        nt.assert_equal(metrics['my.gauge'], 2)
+        nt.assert_equal(metrics['my.set'], 2)
+        nt.assert_equal(metrics['my.hist.count'], 2)
+        nt.assert_equal(metrics['my.hist.max'], 3)
+        nt.assert_equal(metrics['my.hist.avg'], 2)
+
+        # The limits are enforced across the listeners
+        master = MetricsAggregator('myhost', max_contexts_per_name=3)
+        for i in xrange(2):
+            worker = MetricsAggregator('myhost')
+            worker.submit_packets('my.counter:1|c|#worker:%s,a\nmy.counter:1|c|#worker:%s,b' % (i, i))
+            master.merge_partial(*worker.flush_partial())
+        nt.assert_equal(master.num_context_overflows, 1)
+        nt.assert_equal(master.name_contexts, {'my.counter': 3})
+
+        # A context submitted with different types to the listeners keeps
+        # the first one.
+        master = MetricsAggregator('myhost')
+        for packet in ('page.views:1|ms', 'page.views:1|c'):
+            worker = MetricsAggregator('myhost')
+            worker.submit_packets(packet)
+            master.merge_partial(*worker.flush_partial())
+        metrics = sorted(m['metric'] for m in master.flush())
+        nt.assert_equal(metrics, ['page.views.95percentile', 'page.views.avg',
+            'page.views.count', 'page.views.max', 'page.views.median'])
+
+    def test_listener_pool(self):
+        stats = MetricsAggregator('myhost', max_contexts_per_name=3)
+        port = self.free_port()
+        pool = ListenerPool(stats, 2, '127.0.0.1', port,
+            aggregator_kwargs={'max_contexts_per_name': 3})
+        pool.prefork()
+        t = threading.Thread(target=pool.start)
+        t.start()
+        try:
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            def collect(count):
+                deadline = time.time() + 5
+                while stats.count < count and time.time() < deadline:
+                    time.sleep(0.05)
+                    pool.collect()
+
+            # Wait for the listeners to be bound.
+            deadline = time.time() + 5
+            while not stats.count and time.time() < deadline:
+                client.sendto('pool.probe:1|c', ('127.0.0.1', port))
+                time.sleep(0.05)
+                pool.collect()
+            base = stats.count
+            assert base
+
+            for i in xrange(100):
+                client.sendto('pool.counter:1|c', ('127.0.0.1', port))
+            for i in xrange(10):
+                client.sendto('pool.tagged:1|c|#id:%s' % i, ('127.0.0.1', port))
+            collect(base + 110)
+            nt.assert_equal(stats.count, base + 110)
+        finally:
+            pool.stop()
+            t.join()
+
+        metrics = stats.flush()
+        counts = [m['points'][0][1] for m in metrics if m['metric'] == 'pool.counter']
+        nt.assert_equal(counts, [100])
+        # The context limits apply to the merged contexts.
+        nt.assert_equal(len([m for m in metrics if m['metric'] == 'pool.tagged']), 3)
+        assert pool.flush_stats()['packets_per_wakeup'] >= 1
+
+    @staticmethod
+    def free_port():
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def test_server_drains_socket(self):
+        self._test_server(queue_size=None)
+
+    def test_server_with_queue(self):
+        server = self._test_server(queue_size=1000)
+        stats = server.flush_stats()
+        nt.assert_equal(stats['queue_depth'], 0)
+        nt.assert_equal(stats['queue_drops'], 0)
+
+    def _test_server(self, queue_size):
+        stats = MetricsAggregator('myhost')
+        port = self.free_port()
+
+        server = Server(stats, '127.0.0.1', port, buffer_size=4096, so_rcvbuf=65536,
+            queue_size=queue_size)
+        nt.assert_equal(server.buffer_size, 4096)
+        t = threading.Thread(target=server.start)
+        t.start()
+        try:
+            time.sleep(0.2)
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for i in xrange(50):
+                client.sendto('drained.counter:1|c', ('127.0.0.1', port))
+            time.sleep(0.5)
+        finally:
+            server.stop()
+            # Wake the select loop up so it notices we're stopping.
+            client.sendto('drained.counter:0|c', ('127.0.0.1', port))
+            t.join()
+
+        # Let the consumer thread catch up if there is one.
+        time.sleep(0.1)
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 50)
+
+        assert server.flush_stats()['packets_per_wakeup'] >= 1
+        nt.assert_equal(server.packet_count, 0)
+        nt.assert_equal(server.wakeup_count, 0)
+        return server
+
+    def test_server_unix_socket(self):
+        stats = MetricsAggregator('myhost')
+        path = os.path.join(tempfile.mkdtemp(), 'dogstatsd.sock')
+        server = Server(stats, '127.0.0.1', self.free_port(), socket_path=path,
+            socket_mode='0620')
+        t = threading.Thread(target=server.start)
+        t.start()
+        try:
+            time.sleep(0.2)
+            nt.assert_equal(os.stat(path).st_mode & 0777, 0620)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            client.connect(path)
+            for i in xrange(10):
+                client.send('unix.counter:1|c')
+            time.sleep(0.2)
+        finally:
+            server.stop()
+            client.send('unix.counter:0|c')
+            t.join()
+
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 10)
+        # The socket is cleaned up on exit
+        assert not os.path.exists(path)
+
+        # A socket left by a previous run is replaced, other files are not.
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.close()
+        bind_unix_socket(path).close()
+        os.remove(path)
+        f = open(path, 'w')
+        f.write('not a socket')
+        f.close()
+        nt.assert_raises(Exception, bind_unix_socket, path)
+        nt.assert_equal(open(path).read(), 'not a socket')
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    def test_packet_queue_overflow(self):
+        q = PacketQueue(2, 'drop_newest')
+        for packet in ['a', 'b', 'c']:
+            q.put(packet)
+        nt.assert_equal(list(q.get_all(0)), ['a', 'b'])
+        nt.assert_equal(q.pop_drop_count(), 1)
+        nt.assert_equal(q.pop_drop_count(), 0)
+
+        q = PacketQueue(2, 'drop_oldest')
+        for packet in ['a', 'b', 'c']:
+            q.put(packet)
+        nt.assert_equal(list(q.get_all(0)), ['b', 'c'])
+        nt.assert_equal(q.pop_drop_count(), 1)
+
+        q = PacketQueue(2, 'block')
+        q.put('a')
+        q.put('b')
+        t = threading.Thread(target=q.put, args=('c',))
+        t.start()
+        time.sleep(0.1)
+        # The producer waits for room instead of dropping
+        assert t.isAlive()
+        nt.assert_equal(list(q.get_all(0)), ['a', 'b'])
+        t.join(1)
+        nt.assert_equal(list(q.get_all(0)), ['c'])
+        nt.assert_equal(q.pop_drop_count(), 0)
+
+        nt.assert_raises(Exception, PacketQueue, 2, 'unknown')
+        nt.assert_raises(Exception, PacketQueue, 0)
+
+    def test_udp_drops(self):
+        proc_net_udp = """   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  12: 0100007F:1FBD 00000000:0000 07 00000000:00000000 00:00000000 00000000   101        0 10986 2 ffff880037e2c000 42
+  13: 00000000:0044 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 8813 2 ffff880037e2c380 3
+"""
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, proc_net_udp)
+            os.close(fd)
+            nt.assert_equal(get_udp_drops(8125, path), 42)
+            nt.assert_equal(get_udp_drops(68, path), 3)
+            nt.assert_equal(get_udp_drops(9999, path), 0)
+        finally:
+            os.remove(path)
+        nt.assert_equal(get_udp_drops(8125, '/does/not/exist'), None)
+
+    def test_serialize_chunks(self):
+        metrics = [{'metric': 'my.metric.%s' % i, 'points': [(1, i)]}
+            for i in xrange(100)]
+        chunks = list(serialize(metrics, max_size=1000))
+        assert len(chunks) > 1
+        for chunk in chunks[:-1]:
+            assert len(chunk) <= 1000 + len('{"series": []}')
+        series = []
+        for chunk in chunks:
+            series.extend(json.loads(chunk)['series'])
+        nt.assert_equal([m['metric'] for m in series], [m['metric'] for m in metrics])
+
+        nt.assert_equal(list(serialize([])), [])
+
+    @staticmethod
+    def api_server(connections, bodies, statuses, delays=None):
+        """ Start an HTTP/1.1 server recording the connections and the series
+        posted to it. It answers with the `statuses` in turn, then 202, after
+        the `delays` in turn, if any. """
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                connections.append(self.connection)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get('Content-Encoding') == 'deflate':
+                    body = zlib.decompress(body)
+                status = statuses and statuses.pop(0) or 202
+                if status < 300:
+                    bodies.append(json.loads(body))
+                if delays:
+                    time.sleep(delays.pop(0))
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # The tests reset connections on purpose
+                pass
+
+        httpd = ThreadedHTTPServer(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        return httpd
+
+    def test_reporter_keep_alive(self):
+        connections = []
+        bodies = []
+        httpd = self.api_server(connections, bodies, [])
+        try:
+            reporter = Reporter(10, MetricsAggregator('myhost'),
+                'http://127.0.0.1:%s' % httpd.server_address[1], read_timeout=5)
+            metrics = [{'metric': 'my.gauge', 'points': [(time.time(), 1)]}]
+            reporter.submit(metrics)
+            nt.assert_equal(len(connections), 1)
+            assert reporter.handshake_latency > 0
+            handshake_latency = reporter.handshake_latency
+
+            # The second flush re-uses the connection
+            reporter.submit(metrics)
+            nt.assert_equal(len(connections), 1)
+            nt.assert_equal(reporter.handshake_latency, handshake_latency)
+            assert reporter.request_latency > 0
+
+            # and a new one is opened when the server closes it.
+            connections[0].shutdown(socket.SHUT_RDWR)
+            reporter.submit(metrics)
+            nt.assert_equal(len(connections), 2)
+            reporter._close()
+
+            nt.assert_equal(len(bodies), 3)
+            nt.assert_equal(bodies[0]['series'][0]['metric'], 'my.gauge')
+        finally:
+            httpd.shutdown()
+
+    def test_reporter_timeouts_are_not_retried(self):
+        connections = []
+        bodies = []
+        httpd = self.api_server(connections, bodies, [], [0, 1])
+        try:
+            reporter = Reporter(10, MetricsAggregator('myhost'),
+                'http://127.0.0.1:%s' % httpd.server_address[1], read_timeout=0.2)
+            reporter._post('{"series": []}', False)
+            # The api got the payload but answered too late on the re-used
+            # connection: it isn't sent again.
+            nt.assert_raises(socket.timeout, reporter._post, '{"series": []}', False)
+            time.sleep(1)
+            nt.assert_equal(len(connections), 1)
+            nt.assert_equal(len(bodies), 2)
+        finally:
+            httpd.shutdown()
+
+    def test_reporter_retries(self):
+        bodies = []
+        httpd = self.api_server([], bodies, [500])
+        try:
+            reporter = Reporter(10, MetricsAggregator('myhost'),
+                'http://127.0.0.1:%s' % httpd.server_address[1], read_timeout=5)
+            queue = reporter.retry_queue
+            reporter.submit([{'metric': 'first', 'points': [(time.time(), 1)]}])
+            nt.assert_equal(len(queue), 1)
+            nt.assert_equal(queue.error_count, 1)
+            assert not queue.time_to_retry()
+
+            # While backing off, new payloads are queued behind.
+            reporter.submit([{'metric': 'second', 'points': [(time.time(), 1)]}])
+            nt.assert_equal(len(queue), 2)
+            nt.assert_equal(bodies, [])
+
+            queue.next_retry = 0
+            reporter.replay()
+            nt.assert_equal(len(queue), 0)
+            nt.assert_equal(queue.error_count, 0)
+            nt.assert_equal([b['series'][0]['metric'] for b in bodies], ['first', 'second'])
+            reporter._close()
+        finally:
+            httpd.shutdown()
+
+    def test_retry_queue(self):
+        queue = RetryQueue(max_size=30)
+        for body in ['a' * 10, 'b' * 10, 'c' * 10, 'd' * 10]:
+            queue.put(body, False)
+        # The oldest payload was dropped to make room
+        nt.assert_equal(len(queue), 3)
+        nt.assert_equal(queue.size, 30)
+        nt.assert_equal(queue.pop_drop_count(), 1)
+        nt.assert_equal(queue.peek(), ('b' * 10, False))
+        queue.pop()
+        nt.assert_equal(queue.size, 20)
+
+        queue.error(now=100)
+        queue.error(now=100)
+        assert not queue.time_to_retry(now=110)
+        assert queue.time_to_retry(now=120)
+        queue.success()
+        assert queue.time_to_retry(now=1)
+
+        # Payloads spill to disk past the memory size, and survive a restart.
+        path = tempfile.mkdtemp()
+        try:
+            queue = RetryQueue(max_size=100, memory_size=15, path=path)
+            for body in ['a' * 10, 'b' * 10, 'c' * 10]:
+                queue.put(body, True)
+            nt.assert_equal(len(os.listdir(path)), 2)
+            queue.close()
+            nt.assert_equal(len(os.listdir(path)), 3)
+
+            queue = RetryQueue(max_size=25, path=path)
+            nt.assert_equal(len(queue), 2)
+            nt.assert_equal(queue.peek(), ('b' * 10, True))
+            queue.pop()
+            nt.assert_equal(queue.peek(), ('c' * 10, True))
+            queue.pop()
+            nt.assert_equal(os.listdir(path), [])
+        finally:
+            shutil.rmtree(path)
+
 if __name__ == "__main__":
     unittest.main()
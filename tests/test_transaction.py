@@ -1,9 +1,16 @@
 import unittest
 from datetime import timedelta, datetime
+import os
+import shutil
+import tempfile
 import time
+import zlib
 
-from transaction import Transaction, TransactionManager
-from ddagent import MAX_WAIT_FOR_REPLAY, MAX_QUEUE_SIZE, THROTTLING_DELAY
+from transaction import Transaction, TransactionLog, TransactionManager, TokenBucket, \
+    REPLAY_RATE_WINDOW
+from ddagent import MAX_WAIT_FOR_REPLAY, MAX_QUEUE_SIZE, THROTTLING_DELAY, \
+    APIMetricTransaction, SeriesBatcher
+from util import json
 
 class memTransaction(Transaction):
     def __init__(self, size, manager):
@@ -23,6 +30,42 @@ class memTransaction(Transaction):
 
         self._trManager.flush_next()
 
+    def dump(self):
+        return {'size': self._size}, 'payload %s' % self._id
+
+    @classmethod
+    def load(cls, meta, data):
+        tr = cls(meta['size'], cls.manager)
+        tr.data = data
+        return tr
+
+class asyncTransaction(memTransaction):
+    """ Waits for respond to be called to complete """
+
+    def flush(self):
+        self._flush_count = self._flush_count + 1
+
+    def respond(self):
+        if self.is_flushable:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self)
+
+        self._trManager.flush_next()
+
+class recordingManager(object):
+    """ Keeps the transactions it's given without sending them """
+
+    def __init__(self):
+        self.transactions = []
+
+    def append(self, tr):
+        self.transactions.append(tr)
+        tr.set_id(len(self.transactions))
+
+    def flush(self):
+        pass
+
 class TestTransaction(unittest.TestCase):
 
     def setUp(self):
@@ -45,7 +88,7 @@ class TestTransaction(unittest.TestCase):
         # There should be exactly step transaction in the list, with
         # a flush count of 1
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count,1)
 
         # Try to add one more
@@ -54,13 +97,13 @@ class TestTransaction(unittest.TestCase):
 
         # At this point, transaction one (the oldest) should have been removed from the list 
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id,1)
 
         trManager.flush()
         self.assertEqual(len(trManager._transactions), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -93,6 +136,228 @@ class TestTransaction(unittest.TestCase):
             "before = %s after = %s" % (before, after))
             
 
+    def testParallelism(self):
+        """Test sending several transactions at once"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+            timedelta(seconds=0), max_parallelism=3)
+        trs = [asyncTransaction(10, trManager) for i in xrange(7)]
+        for tr in trs:
+            tr.is_flushable = True
+            trManager.append(tr)
+
+        trManager.flush()
+        in_flight = [tr for tr in trs if tr._flush_count]
+        self.assertEqual(len(in_flight), 3)
+
+        # No new flush while some transactions are in flight
+        trManager.flush()
+        self.assertEqual(sum(tr._flush_count for tr in trs), 3)
+
+        # Each response lets another transaction go
+        in_flight[0].respond()
+        self.assertEqual(sum(tr._flush_count for tr in trs), 4)
+        while trManager._transactions:
+            for tr in trs:
+                if tr._flush_count and tr in trManager.get_transactions():
+                    tr.respond()
+        self.assertEqual([tr._flush_count for tr in trs], [1] * 7)
+        self.assertEqual(trManager._trs_to_flush, None)
+
+    def testTokenBucket(self):
+        bucket = TokenBucket(10, 3)
+        self.assertEqual([bucket.take() for i in xrange(3)], [0, 0, 0])
+        delay = bucket.take()
+        self.assertTrue(0 < delay <= 0.1, delay)
+        time.sleep(delay)
+        self.assertEqual(bucket.take(), 0)
+
+        # No limit
+        bucket = TokenBucket(0)
+        self.assertEqual([bucket.take() for i in xrange(100)], [0] * 100)
+
+        # Bursts go through right away, then transactions are throttled
+        trManager = TransactionManager(timedelta(seconds = 0), MAX_QUEUE_SIZE,
+            timedelta(seconds=0.1), max_parallelism=10, throttling_burst=5)
+        trManager._flush_without_ioloop = True
+        for i in xrange(8):
+            tr = memTransaction(10, trManager)
+            tr.is_flushable = True
+            trManager.append(tr)
+        before = time.time()
+        trManager.flush()
+        duration = time.time() - before
+        self.assertEqual(len(trManager._transactions), 0)
+        self.assertTrue(0.25 < duration < 0.5, duration)
+
+    def testQueueStats(self):
+        """Test the byte accounting and the queue statistics"""
+        tr = APIMetricTransaction.load({'headers': {'Content-Type': 'application/json'}},
+            '{"series": []}')
+        self.assertEqual(tr.get_size(), len('{"series": []}') +
+            len('Content-Type: application/json\r\n'))
+
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+            timedelta(seconds=0))
+        stats = trManager.get_stats()
+        self.assertEqual(stats['queue_length'], 0)
+        self.assertEqual(stats['queue_size'], 0)
+        self.assertEqual(stats['oldest_age'], None)
+
+        trs = [memTransaction(100, trManager) for i in xrange(3)]
+        trs[0]._created_at -= 60
+        for tr in trs:
+            trManager.append(tr)
+        trManager.flush()
+        stats = trManager.get_stats()
+        self.assertEqual(stats['queue_length'], 3)
+        self.assertEqual(stats['queue_size'], 300)
+        self.assertTrue(60 <= stats['oldest_age'] < 70, stats['oldest_age'])
+        self.assertEqual(stats['replay_rate'], 0)
+
+        # All of them failed once: sending them now counts as replays
+        for tr in trs:
+            tr.is_flushable = True
+        trManager._last_stats = (time.time() - REPLAY_RATE_WINDOW, 0)
+        trManager.flush()
+        stats = trManager.get_stats()
+        self.assertEqual(stats['queue_length'], 0)
+        self.assertEqual(stats['oldest_age'], None)
+        self.assertAlmostEqual(stats['replay_rate'], 3.0 / REPLAY_RATE_WINDOW, places=2)
+
+        # The rate is kept until the end of the next window
+        trManager.flush()
+        self.assertAlmostEqual(trManager.get_stats()['replay_rate'],
+            3.0 / REPLAY_RATE_WINDOW, places=2)
+
+    def testSeriesBatcher(self):
+        """Test merging series payloads"""
+        trManager = recordingManager()
+        APIMetricTransaction.set_tr_manager(trManager)
+        try:
+            def payload(*names):
+                return json.dumps({'series': [{'metric': name} for name in names]})
+
+            batcher = SeriesBatcher(window=10, max_size=100)
+            batcher.add(payload('a', 'b'), {'Content-Type': 'application/json'})
+            batcher.add(zlib.compress(payload('c')), {'Content-Encoding': 'deflate'})
+            self.assertEqual(trManager.transactions, [])
+            batcher.flush()
+
+            self.assertEqual(len(trManager.transactions), 1)
+            tr = trManager.transactions[0]
+            self.assertEqual(tr._headers['Content-Encoding'], 'deflate')
+            series = json.loads(zlib.decompress(tr._data))['series']
+            self.assertEqual([m['metric'] for m in series], ['a', 'b', 'c'])
+
+            # Payloads are sent before going over the maximum size
+            batcher.add(payload('d' * 40), {})
+            batcher.add(payload('e' * 40), {})
+            self.assertEqual(len(trManager.transactions), 2)
+            batcher.add(payload('f' * 100), {})
+            self.assertEqual(len(trManager.transactions), 4)
+            batcher.flush()
+            self.assertEqual(len(trManager.transactions), 4)
+
+            # Payloads that can't be merged go on their own
+            batcher.add('not json', {})
+            self.assertEqual(trManager.transactions[-1]._data, 'not json')
+
+            batcher = SeriesBatcher(window=0)
+            batcher.add(payload('g'), {})
+            self.assertEqual(trManager.transactions[-1]._data, payload('g'))
+        finally:
+            del APIMetricTransaction._trManager
+
+    def testTransactionLog(self):
+        """Test spilling transactions to the log and reading them back"""
+        path = tempfile.mkdtemp()
+        try:
+            trLog = TransactionLog(path, segment_size=100)
+            trManager = TransactionManager(timedelta(seconds=0), 300,
+                timedelta(seconds=0), transaction_log=trLog,
+                transaction_types=[memTransaction])
+            memTransaction.manager = trManager
+
+            # 3 transactions fit in memory, the next ones go to the log
+            for i in xrange(10):
+                trManager.append(memTransaction(100, trManager))
+            self.assertEqual(len(trManager._transactions), 3)
+            self.assertEqual(len(trLog), 7)
+            self.assertTrue(len(os.listdir(path)) > 1)
+
+            # Nothing can be sent: the log is kept as is
+            trManager.flush()
+            self.assertEqual(len(trManager._transactions), 3)
+
+            # Send the first ones: the oldest of the log are read back
+            for tr in trManager.get_transactions():
+                tr.is_flushable = True
+            trManager.flush()
+            self.assertEqual(len(trManager._transactions), 0)
+            trManager.flush()
+            self.assertEqual(len(trManager._transactions), 3)
+            self.assertEqual([tr.data for tr in trManager.get_transactions()],
+                ['payload 4', 'payload 5', 'payload 6'])
+            self.assertEqual(len(trLog), 4)
+
+            # Stop and restart: in memory transactions are written to the
+            # log, and everything is replayed.
+            trManager.close()
+            trLog = TransactionLog(path, segment_size=100)
+            self.assertEqual(len(trLog), 7)
+            trManager = TransactionManager(timedelta(seconds=0), 300,
+                timedelta(seconds=0), transaction_log=trLog,
+                transaction_types=[memTransaction])
+            memTransaction.manager = trManager
+            sent = []
+            while len(trLog) or trManager._transactions:
+                trManager.flush()
+                for tr in trManager.get_transactions():
+                    sent.append(tr.data)
+                    tr.is_flushable = True
+                trManager.flush()
+            self.assertEqual(sorted(sent), sorted('payload %s' % i for i in xrange(4, 11)))
+            # Segments are gone once sent
+            self.assertEqual(os.listdir(path), [])
+        finally:
+            shutil.rmtree(path)
+
+    def testTransactionLogLimits(self):
+        """Test the eviction of old segments and torn writes"""
+        path = tempfile.mkdtemp()
+        try:
+            trLog = TransactionLog(path, max_size=1000, segment_size=300, fsync='always')
+            for i in xrange(30):
+                trLog.append({'i': i}, 'x' * 50)
+            self.assertTrue(trLog.size <= 1000)
+            self.assertEqual(trLog.drop_count + len(trLog), 30)
+            kept = len(trLog)
+            seq, meta, data = trLog.read()
+            self.assertEqual(meta['i'], trLog.drop_count)
+            self.assertEqual(data, 'x' * 50)
+            trLog.close()
+
+            # Simulate a crash in the middle of a write
+            last = os.path.join(path, sorted(os.listdir(path))[-1])
+            f = open(last, 'ab')
+            f.write('\x00\x00\x00\x10garbage')
+            f.close()
+            trLog = TransactionLog(path, max_size=1000, segment_size=300)
+            # The record read but not resolved is replayed too
+            self.assertEqual(len(trLog), kept)
+            trLog.append({'i': 30}, 'y')
+            records = []
+            while len(trLog):
+                seq, meta, data = trLog.read()
+                records.append(meta['i'])
+                trLog.resolve(seq)
+            self.assertEqual(records[-2:], [29, 30])
+            self.assertEqual(os.listdir(path), [])
+            self.assertRaises(ValueError, TransactionLog, path, fsync='sometimes')
+        finally:
+            shutil.rmtree(path)
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,23 +1,53 @@
 # stdlib
-import sys
+from collections import deque
+import heapq
 import time
 from datetime import datetime, timedelta
 import logging
-from operator import attrgetter
+import os
+import struct
+import zlib
 
 # vendor
 import tornado.ioloop
 
 # project
 from checks.check_status import ForwarderStatus
+from util import json
 
 log = logging.getLogger(__name__)
 
+# Transaction log segments are rotated past this size
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024 # 4MB
+# Once the log is bigger than this, its oldest segments are dropped
+DEFAULT_LOG_MAX_SIZE = 256 * 1024 * 1024 # 256MB
+
+# When to fsync the transaction log: after every append, at most every
+# FSYNC_DELAY seconds, or only when closing it.
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+FSYNC_DELAY = 1
+
+# The replay rate is measured over windows of at least that many seconds,
+# rather than between flushes, which happen on every incoming transaction.
+REPLAY_RATE_WINDOW = 15
+
+# Record header: meta length, data length, crc32 of both
+RECORD_HEADER = struct.Struct('>IIi')
+
 def plural(count):
     if count > 1:
         return "s"
     return ""
 
+def total_seconds(td):
+    # Python 2.7 has this built in, python < 2.7 don't...
+    if hasattr(td,'total_seconds'):
+        return td.total_seconds()
+    return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
+
 class ImplementationError(Exception): pass
 
 class Transaction(object):
@@ -27,7 +57,10 @@ class Transaction(object):
         self._id = None
         self._error_count = 0
         self._next_flush = datetime.now()        
+        self._created_at = time.time()
         self._size = None
+        # Transaction log segment the transaction was read back from
+        self._segment = None
 
     def get_id(self):
         return self._id
@@ -42,12 +75,19 @@ class Transaction(object):
     def get_error_count(self):
         return self._error_count 
 
+    def get_created_at(self):
+        return self._created_at
+
     def get_size(self):
         if self._size is None:
-            self._size = sys.getsizeof(self)
+            self._size = self.compute_size()
 
         return self._size
 
+    def compute_size(self):
+        """ Return how many bytes the transaction holds. """
+        raise ImplementationError("To be implemented in a subclass")
+
     def get_next_flush(self):
         return self._next_flush
 
@@ -67,34 +107,347 @@ class Transaction(object):
     def flush(self):
         raise ImplementationError("To be implemented in a subclass")
 
+    def dump(self):
+        """ Return a (meta, data) pair to write the transaction to a
+        TransactionLog, meta being a json-serializable dict. """
+        raise ImplementationError("To be implemented in a subclass")
+
+    @classmethod
+    def load(cls, meta, data):
+        """ Rebuild a transaction from what dump returned. """
+        raise ImplementationError("To be implemented in a subclass")
+
+
+class Segment(object):
+    """ A file of a TransactionLog. """
+
+    __slots__ = ('seq', 'path', 'size', 'unread', 'pending')
+
+    def __init__(self, seq, path):
+        self.seq = seq
+        self.path = path
+        self.size = 0
+        # (offset, length) of the records not read back yet
+        self.unread = deque()
+        # Number of records read back but not resolved yet
+        self.pending = 0
+
+
+class TransactionLog(object):
+    """
+    An append-only log of the transactions that don't fit in memory, split
+    in segment files in `path` so that it survives a restart. Records are
+    read back oldest first, and a segment is removed once all of its records
+    have been read back and resolved, i.e. sent or given up on. When the log
+    holds more than `max_size` bytes, its oldest segments are dropped.
+
+    A segment that was only partly resolved when the forwarder stopped is
+    replayed in full on the next start, so transactions are sent at least
+    once.
+    """
+
+    def __init__(self, path, max_size=None, segment_size=None, fsync=None):
+        self.path = path
+        self.max_size = int(max_size or DEFAULT_LOG_MAX_SIZE)
+        self.segment_size = int(segment_size or DEFAULT_SEGMENT_SIZE)
+        self.fsync = fsync or FSYNC_INTERVAL
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %r, use one of %s" % (
+                self.fsync, ', '.join(FSYNC_POLICIES)))
+
+        self.size = 0
+        self.unread_count = 0
+        self.drop_count = 0
+
+        self._segments = deque()
+        self._seq = 0
+        self._writer = None
+        self._reader = None
+        self._dirty = False
+        self._last_sync = 0
+        self._load()
+
+    def __len__(self):
+        return self.unread_count
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, '%020d.log' % seq)
+
+    def _load(self):
+        """ Pick up the segments a previous run left on disk. """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        seqs = []
+        for filename in os.listdir(self.path):
+            try:
+                seq, extension = filename.split('.')
+                seq = int(seq)
+            except ValueError:
+                continue
+            if extension == 'log':
+                seqs.append(seq)
+        seqs.sort()
+
+        for seq in seqs:
+            segment = Segment(seq, self._segment_path(seq))
+            self._scan(segment)
+            self._seq = seq + 1
+            if segment.unread:
+                self._segments.append(segment)
+                self.size += segment.size
+                self.unread_count += len(segment.unread)
+            else:
+                self._remove(segment)
+        self._evict(0)
+        if self.unread_count:
+            log.info("%s transactions (%s bytes) to replay from %s" % (
+                self.unread_count, self.size, self.path))
+
+    def _scan(self, segment):
+        """ Index the records of a segment, up to the first incomplete or
+        corrupted one, e.g. from a crash in the middle of a write. """
+        f = open(segment.path, 'rb')
+        try:
+            while True:
+                offset = f.tell()
+                header = f.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                try:
+                    meta_length, data_length, crc = RECORD_HEADER.unpack(header)
+                except struct.error:
+                    log.warn("Truncated record at %s:%s" % (segment.path, offset))
+                    break
+                body = f.read(meta_length + data_length)
+                if len(body) < meta_length + data_length or zlib.crc32(body) != crc:
+                    log.warn("Corrupted record at %s:%s" % (segment.path, offset))
+                    break
+                length = RECORD_HEADER.size + len(body)
+                segment.unread.append((offset, length))
+                segment.size += length
+        finally:
+            f.close()
+
+    def _remove(self, segment):
+        if self._writer is not None and self._writer[0] is segment:
+            self._writer[1].close()
+            self._writer = None
+            self._dirty = False
+        if self._reader is not None and self._reader[0] is segment:
+            self._reader[1].close()
+            self._reader = None
+        try:
+            os.remove(segment.path)
+        except OSError:
+            pass
+
+    def _evict(self, size):
+        while self._segments and self.size + size > self.max_size:
+            segment = self._segments.popleft()
+            self.size -= segment.size
+            self.unread_count -= len(segment.unread)
+            self.drop_count += len(segment.unread)
+            self._remove(segment)
+            log.warn("Transaction log is too big, dropped %s transaction%s" % (
+                len(segment.unread), plural(len(segment.unread))))
+
+    def append(self, meta, data):
+        """ Write a record at the end of the log, return False if it was
+        dropped for being bigger than the log. """
+        meta = json.dumps(meta)
+        body = meta + data
+        record = RECORD_HEADER.pack(len(meta), len(data), zlib.crc32(body)) + body
+        if len(record) > self.max_size:
+            self.drop_count += 1
+            return False
+        self._evict(len(record))
+
+        if self._writer is None or self._writer[0].size >= self.segment_size:
+            self._rotate()
+        segment, f = self._writer
+        f.write(record)
+        # Records must be readable right away.
+        f.flush()
+        self._dirty = True
+        segment.unread.append((segment.size, len(record)))
+        segment.size += len(record)
+        self.size += len(record)
+        self.unread_count += 1
+        self.sync()
+        return True
+
+    def _rotate(self):
+        if self._writer is not None:
+            self.sync(force=True)
+            self._writer[1].close()
+        segment = Segment(self._seq, self._segment_path(self._seq))
+        self._seq += 1
+        self._writer = (segment, open(segment.path, 'ab'))
+        self._segments.append(segment)
+
+    def sync(self, force=False):
+        """ Flush the segment being written to disk, as the fsync policy
+        says or right away if `force` is set. """
+        if not self._dirty:
+            return
+        now = time.time()
+        if force or self.fsync == FSYNC_ALWAYS or \
+                (self.fsync == FSYNC_INTERVAL and now - self._last_sync >= FSYNC_DELAY):
+            os.fsync(self._writer[1].fileno())
+            self._dirty = False
+            self._last_sync = now
+
+    def read(self):
+        """ Return the oldest unread record as a (segment sequence number,
+        meta, data) tuple, or None if there are none. The record must be
+        resolved once done with. """
+        for segment in self._segments:
+            if segment.unread:
+                break
+        else:
+            return None
+
+        if self._reader is None or self._reader[0] is not segment:
+            if self._reader is not None:
+                self._reader[1].close()
+            self._reader = (segment, open(segment.path, 'rb'))
+        f = self._reader[1]
+        offset, length = segment.unread.popleft()
+        f.seek(offset)
+        record = f.read(length)
+        meta_length, _, _ = RECORD_HEADER.unpack(record[:RECORD_HEADER.size])
+        meta = json.loads(record[RECORD_HEADER.size:RECORD_HEADER.size + meta_length])
+        data = record[RECORD_HEADER.size + meta_length:]
+        segment.pending += 1
+        self.unread_count -= 1
+
+        # Don't append to a segment we're done reading, so it can go away.
+        if not segment.unread and self._writer is not None and self._writer[0] is segment:
+            self.sync(force=True)
+            self._writer[1].close()
+            self._writer = None
+        return segment.seq, meta, data
+
+    def resolve(self, seq):
+        """ Mark a record of segment `seq` that was read back as done. """
+        for segment in self._segments:
+            if segment.seq == seq:
+                break
+        else:
+            # The segment was evicted.
+            return
+        segment.pending -= 1
+        if not segment.pending and not segment.unread and \
+                (self._writer is None or self._writer[0] is not segment):
+            self._segments.remove(segment)
+            self.size -= segment.size
+            self._remove(segment)
+
+    def close(self):
+        if self._writer is not None:
+            self.sync(force=True)
+            self._writer[1].close()
+            self._writer = None
+        if self._reader is not None:
+            self._reader[1].close()
+            self._reader = None
+
+class TokenBucket(object):
+    """ Allows `rate` events per second on average, in bursts of up to
+    `capacity` events. A rate of 0 means no limit. """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.last_update = time.time()
+
+    def take(self):
+        """ Take a token, return 0 if there was one or else how many seconds
+        until there is one. """
+        if not self.rate:
+            return 0
+        now = time.time()
+        self.tokens = min(self.capacity,
+            self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
-       are all commited, without exceeding parameters (throttling, memory consumption) """
+       are all commited, without exceeding parameters (throttling, memory consumption)
+
+       With a transaction log, transactions beyond max_queue_size are written
+       to it instead of being dropped, and read back as the queue drains.
+       transaction_types are the Transaction classes found in the log.
+
+       Up to max_parallelism transactions are sent at once, one every
+       throttling_delay on average, with bursts of up to throttling_burst. """
 
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
+                 transaction_log=None, transaction_types=None, max_parallelism=1,
+                 throttling_burst=1):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        self._MAX_PARALLELISM = max(max_parallelism, 1)
+
+        delay = total_seconds(throttling_delay)
+        self._rate_limiter = TokenBucket(delay and 1 / delay, throttling_burst)
+
+        self._log = transaction_log
+        self._transaction_types = dict((cls.__name__, cls)
+            for cls in transaction_types or [])
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = [] #List of all non commited transactions
+        self._transactions = {} # Id -> all non commited transactions
+        self._flush_heap = [] # (next flush, id) of the transactions not in flight
+        self._ids = deque() # Ids by age, may hold ids of committed transactions
         self._total_count = 0 # Maintain size/count not to recompute it everytime
         self._total_size = 0 
         self._flush_count = 0
+        self._replay_count = 0 # Transactions sent after failing at least once
+        self._replay_rate = 0
+        self._last_stats = (time.time(), 0) # (time, replay count)
 
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
         self._counter = 0
 
         self._trs_to_flush = None # Current transactions being flushed
-        self._last_flush = datetime.now() # Last flush (for throttling)
+        self._in_flight = 0 # Transactions sent, waiting for their response
+        self._flush_scheduled = False # Waiting for the rate limiter
 
         # Track an initial status message.
         ForwarderStatus().persist()
 
     def get_transactions(self):
-        return self._transactions
+        return [self._transactions[tr_id] for tr_id in sorted(self._transactions)]
+
+    def get_stats(self):
+        """ Return the queue statistics, in bytes and seconds. """
+        oldest_age = None
+        # Skip the ids of committed transactions.
+        while self._ids and self._ids[0] not in self._transactions:
+            self._ids.popleft()
+        if self._ids:
+            oldest_age = time.time() - self._transactions[self._ids[0]].get_created_at()
+
+        stats = {
+            'queue_length': self._total_count,
+            'queue_size': self._total_size,
+            'oldest_age': oldest_age,
+            'replay_rate': self._replay_rate,
+        }
+        if self._log is not None:
+            stats['log_length'] = len(self._log)
+            stats['log_size'] = self._log.size
+        return stats
 
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" % 
@@ -112,38 +465,115 @@ class TransactionManager(object):
         # Check the size
         tr_size = tr.get_size()
 
+        # Once transactions are in the log, newer ones go after them.
+        if self._log is not None and \
+                (len(self._log) or (self._total_size + tr_size) > self._MAX_QUEUE_SIZE):
+            self.spill(tr)
+            return
+
         log.debug("New transaction to add, total size of queue would be: %s KB" % 
             ((self._total_size + tr_size)/ 1024))
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
+            while self._ids and (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+                tr2 = self._remove(self._ids.popleft())
+                if tr2 is not None:
                     log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
-        self._total_count = self._total_count + 1
-        self._total_size = self._total_size + tr_size
+        self._add(tr)
 
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def _add(self, tr):
+        tr_id = tr.get_id()
+        self._transactions[tr_id] = tr
+        heapq.heappush(self._flush_heap, (tr.get_next_flush(), tr_id))
+        self._ids.append(tr_id)
+        self._total_count = self._total_count + 1
+        self._total_size = self._total_size + tr.get_size()
+
+    def _remove(self, tr_id):
+        """ Forget about a transaction, its flush heap entry is skipped once
+        it comes up. """
+        tr = self._transactions.pop(tr_id, None)
+        if tr is None:
+            return None
+        self._total_count = self._total_count - 1
+        self._total_size = self._total_size - tr.get_size()
+        if tr._segment is not None:
+            self._log.resolve(tr._segment)
+
+        # Drop the ids of committed transactions once they're the majority.
+        if len(self._ids) > 2 * len(self._transactions) + 1024:
+            self._ids = deque(i for i in self._ids if i in self._transactions)
+        return tr
+
+    def spill(self, tr):
+        meta, data = tr.dump()
+        meta['type'] = tr.__class__.__name__
+        meta['error_count'] = tr.get_error_count()
+        meta['created_at'] = tr.get_created_at()
+        if self._log.append(meta, data):
+            log.debug("Transaction %s written to the transaction log" % tr.get_id())
+        else:
+            log.warn("Transaction %s is too big for the transaction log, dropped it" % tr.get_id())
+
+    def read_log(self):
+        """ Move transactions from the log back to the queue, oldest first,
+        as long as the queue has room for them. """
+        if self._log is None:
+            return
+        while len(self._log) and self._total_size < self._MAX_QUEUE_SIZE:
+            seq, meta, data = self._log.read()
+            try:
+                cls = self._transaction_types[meta.pop('type')]
+                error_count = meta.pop('error_count', 0)
+                created_at = meta.pop('created_at', None)
+                tr = cls.load(meta, data)
+            except Exception:
+                log.exception("Cannot read a transaction back from the log, dropped it")
+                self._log.resolve(seq)
+                continue
+            tr._segment = seq
+            tr._error_count = error_count
+            if created_at is not None:
+                tr._created_at = created_at
+            tr.set_id(self.get_tr_id())
+            self._add(tr)
+            log.debug("Transaction %s read back from the transaction log" % tr.get_id())
+
+    def close(self):
+        """ Write the queued transactions to the log so that they are sent
+        after a restart. """
+        if self._log is None:
+            return
+        for tr in self.get_transactions():
+            # Those read back from the log are still in it.
+            if tr._segment is None:
+                self.spill(tr)
+        self._log.close()
+
     def flush(self):
 
         if self._trs_to_flush is not None:
             log.debug("A flush is already in progress, not doing anything")
             return
 
+        if self._log is not None:
+            self.read_log()
+            self._log.sync()
+
         to_flush = []
         # Do we have something to do ?
         now = datetime.now()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
+        heap = self._flush_heap
+        while heap and heap[0][0] < now:
+            next_flush, tr_id = heapq.heappop(heap)
+            tr = self._transactions.get(tr_id)
+            if tr is not None:
                 to_flush.append(tr)
 
         count = len(to_flush)
@@ -153,56 +583,69 @@ class TransactionManager(object):
             self.flush_next()
         self._flush_count += 1
 
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count).persist()
+        now = time.time()
+        last_time, last_replay_count = self._last_stats
+        if now - last_time >= REPLAY_RATE_WINDOW:
+            self._replay_rate = (self._replay_count - last_replay_count) / (now - last_time)
+            self._last_stats = (now, self._replay_count)
+
+        ForwarderStatus(flush_count=self._flush_count, **self.get_stats()).persist()
 
     def flush_next(self):
 
-        if len(self._trs_to_flush) > 0:
+        if self._trs_to_flush is None:
+            return
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.now()
-            # Python 2.7 has this built in, python < 2.7 don't...
-            if hasattr(td,'total_seconds'):
-                delay = td.total_seconds()
-            else:
-                delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
+        while self._trs_to_flush and self._in_flight < self._MAX_PARALLELISM:
 
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.now()
-                log.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    log.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
+            delay = self._rate_limiter.take()
+            if delay > 0:
                 # Wait a little bit more
+                if self._flush_scheduled:
+                    return
                 if  tornado.ioloop.IOLoop.instance().running():
+                    self._flush_scheduled = True
                     tornado.ioloop.IOLoop.instance().add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
+                        self._scheduled_flush_next)
                 elif self._flush_without_ioloop:
-                    # Tornado is no started (ie, unittests), do it manually: BLOCKING                    
+                    # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
-                    self.flush_next()
-        else:
+                    continue
+                return
+
+            tr = self._trs_to_flush.pop()
+            self._in_flight += 1
+            log.debug("Flushing transaction %d" % tr.get_id())
+            try:
+                tr.flush()
+            except Exception,e :
+                log.exception(e)
+                self.tr_error(tr)
+
+        # Responses may have come in synchronously and finished the flush
+        if not self._trs_to_flush and self._in_flight == 0:
             self._trs_to_flush = None
 
+    def _scheduled_flush_next(self):
+        self._flush_scheduled = False
+        self.flush_next()
+
     def tr_error(self,tr):
+        self._in_flight = max(self._in_flight - 1, 0)
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        if tr.get_id() in self._transactions:
+            heapq.heappush(self._flush_heap, (tr.get_next_flush(), tr.get_id()))
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
           (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()), 
            tr.get_next_flush()))
 
     def tr_success(self,tr):
         log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count = self._total_count - 1
-        self._total_size = self._total_size - tr.get_size()
+        self._in_flight = max(self._in_flight - 1, 0)
+        if tr.get_error_count() or tr._segment is not None:
+            self._replay_count += 1
+        self._remove(tr.get_id())
         self.print_queue_stats()
 
 
@@ -133,6 +133,7 @@ class DogstatsdThread(threading.Thread):
         self.reporter, self.server = dogstatsd.init(use_forwarder=True)
 
     def run(self):
+        self.server.prefork()
         self.reporter.start()
         self.server.start()
 